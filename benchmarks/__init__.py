@@ -0,0 +1,4 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
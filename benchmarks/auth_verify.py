@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Measures callback authentication throughput and latency for a growing number of verification workers.
+# Every request authenticates a different user, so each one misses the credential cache and goes through the
+# `auth` admission class, the users lookup and Argon2 verification as a callback with new credentials does.
+# Run from the repository root: python -m benchmarks.auth_verify
+
+import os
+import json
+import asyncio
+import argparse
+import tempfile
+from time import perf_counter
+from os.path import join
+
+from utils import hash, sqlite_connect, percentile
+from create_db import create_tables
+from migrations import migrate
+from server.auth import PasswordVerifier, CredentialCache
+from server.admission import Limiter, Overloaded
+from server.database import Database
+from server.handlers import _get_authenticated_user
+
+
+def build_database(filename: str, users: int) -> None:
+    conn = sqlite_connect(filename)
+    create_tables(conn)
+    migrate(conn)
+    conn.execute("INSERT INTO organizations VALUES ('organization', NULL, 'organization', 0)")
+    # All users share one hash, verifying it costs the same as verifying distinct ones
+    password_hash = hash('password')
+    conn.executemany('INSERT INTO users VALUES (?,?,?,?,?,?)', ((f'user{i}', f'user{i}', None, None, password_hash, 'organization') for i in range(users)))
+    conn.commit()
+    conn.close()
+
+
+async def run(filename: str, workers: int, executor: str, queue: int, requests: int, concurrency: int) -> dict:
+    db = Database(filename, os.cpu_count() or 1)
+    verifier = PasswordVerifier(workers, executor)
+    cache = CredentialCache(requests + workers)
+    # The limits run_server.py gives the auth class for these workers, with a budget long enough not to shed
+    limiter = Limiter('auth', workers, queue, 60)
+    latencies: list[float] = []
+    rejected = 0
+    logins = iter(range(workers, workers + requests))
+
+    async def client():
+        nonlocal rejected
+        for i in logins:
+            started = perf_counter()
+            try:
+                user = await _get_authenticated_user(db, verifier, cache, limiter, f'user{i}', 'password')
+                assert user, 'Authentication failed'
+            except Overloaded:
+                rejected += 1
+            latencies.append(perf_counter() - started)
+
+    # Warm up the pool so process start-up is not measured
+    await asyncio.gather(*(_get_authenticated_user(db, verifier, cache, limiter, f'user{i}', 'password') for i in range(workers)))
+
+    started = perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = perf_counter() - started
+    verifier.close()
+    db.close()
+
+    return {
+        'workers': workers,
+        'executor': executor,
+        'authentications_per_sec': round((requests - rejected) / elapsed, 2),
+        'rejected': rejected,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = join(directory, 'auth.db')
+        build_database(filename, args.max_workers + args.requests)
+        workers = 1
+        while workers <= args.max_workers:
+            print(json.dumps(await run(filename, workers, args.executor, args.queue, args.requests, args.concurrency)))
+            workers *= 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--queue', help='Verifications allowed to wait for a worker, as --auth-queue of run_server.py', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Compares the installed JSON codecs on users_read responses and callback requests.
+# Run from the repository root: python -m benchmarks.json_codec
+
+import json
+import random
+import argparse
+from uuid import UUID
+from timeit import timeit
+
+import server.codec as codec
+from datatypes import CallbackResponse
+from server.callbacks.user_management import USERS_READ_SUCCESS
+
+
+def users_payload(users: int, rng: random.Random) -> dict:
+    items = []
+    for i in range(users):
+        name = f'User {rng.randrange(10 ** 6)}'
+        items.append({'id': str(UUID(int=rng.getrandbits(128), version=4)), 'name': name, 'email': f'{name.lower().replace(" ", ".")}@example.com'})
+    return {'items': items}
+
+
+def callback_request(rng: random.Random) -> bytes:
+    return json.dumps({
+        'type': 'cti.a.p.acgw.request.v1.0~a.p.empty.v1.0',
+        'request_id': str(UUID(int=rng.getrandbits(128), version=4)),
+        'created_at': '2024-01-01T00:00:00Z',
+        'context': {
+            'callback_id': 'cti.a.p.acgw.callback.v1.0~vendor.app.users_read.v1.0',
+            'endpoint_id': 'cti.a.p.acgw.endpoint.v1.0~vendor.app.endpoint.v1.0',
+            'tenant_id': str(UUID(int=rng.getrandbits(128), version=4)),
+            'datacenter_url': 'https://eu8-cloud.acronis.com'
+        },
+        'payload': {}
+    }).encode()
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    payload = users_payload(args.users, rng)
+    request = callback_request(rng)
+    request_id, response_id = 'request-id', 'response-id'
+
+    for name in codec.AVAILABLE:
+        codec.use(name)
+        dumps, loads = codec.dumps, codec.loads
+
+        def full_dict():
+            return dumps(CallbackResponse(type=USERS_READ_SUCCESS.type, request_id=request_id, response_id=response_id, payload=payload))
+
+        def envelope():
+            return USERS_READ_SUCCESS.render(request_id, response_id, dumps(payload))
+
+        assert json.loads(full_dict()) == json.loads(envelope())
+        print(json.dumps({
+            'codec': name,
+            'users': args.users,
+            'response_dict_ms': round(timeit(full_dict, number=args.number) / args.number * 1000, 3),
+            'response_envelope_ms': round(timeit(envelope, number=args.number) / args.number * 1000, 3),
+            'request_decode_us': round(timeit(lambda: loads(request), number=args.number * 100) / args.number / 100 * 10 ** 6, 3),
+        }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Replays the callback requests of postman_collection.json against run_server.py and reports
+# throughput, latency percentiles and error rates per callback as JSON.
+# Run from the repository root: python -m benchmarks.load_test
+#
+# By default a fresh database is generated with create_db.py and a server is started on it.
+# Use --url to load a server that is already running, its root user's credentials are then required.
+
+import re
+import sys
+import json
+import socket
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from uuid import uuid4, uuid5, NAMESPACE_URL
+from time import perf_counter
+from base64 import b64encode
+from datetime import datetime, timezone
+from os.path import join, dirname, realpath
+
+import aiohttp
+
+from constants import ROOT_ORGANIZATION_ID, APPCODE
+from utils import sqlite_connect, percentile
+from server.callbacks import CALLBACKS_MAPPING
+
+ROOT = dirname(dirname(realpath(__file__)))
+COLLECTION = join(ROOT, 'postman_collection.json')
+TENANT_ID = '0dd47bbb-d065-447f-ab7c-06e05887078b'
+VARIABLES = {'AppCode': APPCODE, 'TenantId': TENANT_ID, 'CloudUrl': 'https://eu8-cloud.acronis.com'}
+
+# Resetting the enablement drops the mapping that most of the other callbacks need, so it's not replayed by default
+DEFAULT_WEIGHTS = {'enablement.reset': 0}
+
+
+def short_name(callback_id: str) -> str:
+    """`cti.a.p.acgw.callback.v1.0~a.p.enablement.read.v1.0` -> `enablement.read`"""
+    name = callback_id.split('~')[-1].rsplit('.v', 1)[0]
+    return name.split('.', 2)[-1]
+
+
+def load_templates(path: str) -> dict[str, str]:
+    """Returns the raw request bodies of the collection by callback short name."""
+    templates = {}
+
+    def walk(items: list[dict]):
+        for item in items:
+            if 'item' in item:
+                walk(item['item'])
+                continue
+            raw = item['request']['body']['raw']
+            callback_id = json.loads(substitute(raw, VARIABLES))['context']['callback_id']
+            if callback_id not in CALLBACKS_MAPPING:
+                print(f'Skipping "{item["name"]}", the server has no {callback_id} callback', file=sys.stderr)
+                continue
+            templates[short_name(callback_id)] = raw
+
+    with open(path) as f:
+        walk(json.load(f)['item'])
+    return templates
+
+
+def substitute(raw: str, variables: dict[str, str]) -> str:
+    """Replaces the Postman `{{variables}}`, unknown variables are left as is."""
+    dynamic = {
+        '$guid': lambda: str(uuid4()),
+        '$isoTimestamp': lambda: datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+    }
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+        if name in dynamic:
+            return dynamic[name]()
+        return variables.get(name, match.group(0))
+
+    return re.sub(r'{{\s*([^}\s]+)\s*}}', replace, raw)
+
+
+class Workload:
+    """Builds request bodies from the templates and adjusts the payloads to the data of the generated database."""
+
+    def __init__(self, templates: dict[str, str], customers: list[str], rng: random.Random) -> None:
+        self.templates = templates
+        self.customers = customers
+        self.rng = rng
+
+
+    def body(self, name: str) -> bytes:
+        data = json.loads(substitute(self.templates[name], VARIABLES))
+        payload = data.get('payload')
+        if name == 'enablement.write':
+            payload['acronis_tenant_id'] = TENANT_ID
+            payload['vendor_tenant_id'] = ROOT_ORGANIZATION_ID
+        elif name == 'tenant_mapping.write' and self.customers:
+            # Every customer is always mapped to the same Acronis tenant, so writes can be repeated in any order
+            customer = self.rng.choice(self.customers)
+            payload['modified'] = [{'vendor_tenant_id': customer, 'acronis_tenant_id': str(uuid5(NAMESPACE_URL, customer))}]
+        elif name == 'user_write':
+            login = f'load.{uuid4().hex}'
+            payload.update(login=login, name=login, email=f'{login}@example.com')
+        return json.dumps(data).encode()
+
+
+def auth_headers(login: str, password: str) -> dict[str, str]:
+    credentials = f'{login}:{json.dumps({"password": password})}'
+    return {
+        'Content-Type': 'application/json',
+        'X-CyberApp-Auth': b64encode(credentials.encode()).decode(),
+        'X-CyberApp-Extra': b64encode(b'{}').decode(),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def create_database(db_name: str, login: str, password: str) -> None:
+    subprocess.run(
+        [sys.executable, join(ROOT, 'create_db.py'), '--db-name', db_name, '--root-login', login, '--root-password', password],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def read_customers(filename: str) -> list[str]:
+    db = sqlite_connect(filename)
+    try:
+        return [row['id'] for row in db.execute('SELECT id FROM organizations WHERE parent_id = ?', (ROOT_ORGANIZATION_ID,))]
+    finally:
+        db.close()
+
+
+async def wait_until_ready(session: aiohttp.ClientSession, url: str, server: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited with code {server.returncode}')
+        try:
+            async with session.get(url):
+                return
+        except aiohttp.ClientConnectionError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError('Server did not start in time')
+
+
+async def run(args, url: str, workload: Workload, session: aiohttp.ClientSession) -> dict:
+    headers = auth_headers(args.login, args.password)
+    names = [name for name in workload.templates if args.weights.get(name, 1) > 0]
+    weights = [args.weights.get(name, 1) for name in names]
+
+    async def send(name: str) -> tuple[int, float]:
+        body = workload.body(name)
+        started = perf_counter()
+        try:
+            async with session.post(f'{url}/callback', data=body, headers=headers) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError:
+            status = 0
+        return status, perf_counter() - started
+
+    # Enable the application for the root organization and touch every callback once before measuring
+    await send('enablement.write')
+    for name in names:
+        await send(name)
+
+    results: dict[str, tuple[list[float], dict[int, int]]] = {name: ([], {}) for name in names}
+    sent = 0
+    deadline = perf_counter() + args.duration
+
+    async def client():
+        nonlocal sent
+        while perf_counter() < deadline and (not args.requests or sent < args.requests):
+            sent += 1
+            name = workload.rng.choices(names, weights)[0]
+            status, latency = await send(name)
+            latencies, statuses = results[name]
+            latencies.append(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = perf_counter() - started
+
+    callbacks = {}
+    total = errors = 0
+    for name, (latencies, statuses) in results.items():
+        if not latencies:
+            continue
+        failed = sum(count for status, count in statuses.items() if status != 200)
+        total += len(latencies)
+        errors += failed
+        callbacks[name] = {
+            'requests': len(latencies),
+            'requests_per_sec': round(len(latencies) / elapsed, 2),
+            'error_rate': round(failed / len(latencies), 4),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        }
+
+    return {
+        'concurrency': args.concurrency,
+        'duration_sec': round(elapsed, 2),
+        'requests': total,
+        'requests_per_sec': round(total / elapsed, 2) if elapsed else 0,
+        'error_rate': round(errors / total, 4) if total else 0,
+        'callbacks': callbacks,
+    }
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    templates = load_templates(args.collection)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server = None
+        customers = []
+        if args.url:
+            url = args.url.rstrip('/')
+            if args.db_name:
+                customers = read_customers(join(ROOT, f'{args.db_name}.db'))
+        else:
+            db_name = args.db_name
+            if not db_name:
+                db_name = join(tmp, 'load')
+                create_database(db_name, args.login, args.password)
+            customers = read_customers(join(ROOT, f'{db_name}.db'))
+
+            port = free_port()
+            url = f'http://127.0.0.1:{port}'
+            log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+            server = subprocess.Popen(
+                [sys.executable, join(ROOT, 'run_server.py'), '--db-name', db_name, '--port', str(port), *args.server_args.split()],
+                stdout=log, stderr=log)
+
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                if server:
+                    await wait_until_ready(session, url, server)
+                report = await run(args, url, Workload(templates, customers, rng), session)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def weight(value: str) -> tuple[str, float]:
+    name, _, share = value.partition('=')
+    return name, float(share)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--collection', help='Postman collection with the request templates', default=COLLECTION)
+    parser.add_argument('--url', help='Base URL of a running server, a new one is started if not specified')
+    parser.add_argument('--db-name', help='Database to serve, a new one is generated if not specified')
+    parser.add_argument('--login', help='Root user\'s login', default='root')
+    parser.add_argument('--password', help='Root user\'s password', default='password')
+    parser.add_argument('--server-args', help='Extra arguments for run_server.py', default='')
+    parser.add_argument('--server-log', help='File to write the server output to')
+    parser.add_argument('--concurrency', help='Number of concurrent clients', type=int, default=16)
+    parser.add_argument('--duration', help='Seconds to run the load for', type=float, default=10)
+    parser.add_argument('--requests', help='Stop after this many requests', type=int, default=0)
+    parser.add_argument('--weight', help='Relative share of a callback as <name>=<weight>, e.g. users_read=5, can be repeated', type=weight, action='append', default=[])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to write the JSON report to')
+
+    args = parser.parse_args()
+    args.weights = {**DEFAULT_WEIGHTS, **dict(args.weight)}
+
+    asyncio.run(main(args))
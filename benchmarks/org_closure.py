@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Compares the recursive CTE and the organizations closure table when listing the customers of a partner.
+# Run from the repository root: python -m benchmarks.org_closure
+
+import json
+import random
+import sqlite3
+import argparse
+from time import perf_counter
+
+from datatypes import OrganizationKind
+from utils import create_organizations_closure
+
+RECURSIVE_CTE = '''WITH RECURSIVE organizations_tree AS (
+    SELECT id, name, kind, parent_id AS direct_parent_id, parent_id FROM organizations
+
+    UNION ALL
+
+    SELECT p.id, p.name, p.kind, p.parent_id AS direct_parent_id, (SELECT parent_id FROM organizations WHERE id = p.parent_id) AS parent
+    FROM organizations_tree AS p
+    WHERE parent IS NOT NULL
+)
+SELECT id, name FROM organizations_tree WHERE parent_id = ? AND kind = ?'''
+
+CLOSURE = '''SELECT orgs.id, orgs.name
+FROM organizations_closure AS tree
+JOIN organizations AS orgs ON orgs.id = tree.descendant_id
+WHERE tree.ancestor_id = ? AND tree.depth > 0 AND orgs.kind = ?'''
+
+
+def build_tree(db: sqlite3.Connection, depth: int, fanout: int, customers: int) -> list[str]:
+    """Creates a tree of partners with `customers` customers under every leaf partner, returns partner IDs."""
+    db.execute('CREATE TABLE organizations (id VARCHAR(36) NOT NULL PRIMARY KEY, parent_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE, name VARCHAR(255), kind TINYINT) WITHOUT ROWID')
+    db.execute('CREATE INDEX organization_parent_idx ON organizations(parent_id)')
+    create_organizations_closure(db)
+
+    partners, level = ['p'], ['p']
+    db.execute('INSERT INTO organizations VALUES (?,?,?,?)', ('p', None, 'p', OrganizationKind.PARTNER))
+    for _ in range(depth):
+        rows = [(f'{parent}.{i}', parent, f'{parent}.{i}', OrganizationKind.PARTNER) for parent in level for i in range(fanout)]
+        db.executemany('INSERT INTO organizations VALUES (?,?,?,?)', rows)
+        level = [row[0] for row in rows]
+        partners += level
+    db.executemany('INSERT INTO organizations VALUES (?,?,?,?)', (
+        (f'{parent}.c{i}', parent, f'{parent}.c{i}', OrganizationKind.CUSTOMER) for parent in level for i in range(customers)
+    ))
+    db.commit()
+    return partners
+
+
+def measure(db: sqlite3.Connection, sql: str, partners: list[str], queries: int) -> float:
+    started = perf_counter()
+    for partner_id in partners[:queries]:
+        db.execute(sql, (partner_id, OrganizationKind.CUSTOMER)).fetchall()
+    return (perf_counter() - started) / queries * 1000
+
+
+def main(args):
+    db = sqlite3.connect(':memory:')
+    db.execute('PRAGMA foreign_keys=ON')
+
+    started = perf_counter()
+    partners = build_tree(db, args.depth, args.fanout, args.customers)
+    build_time = perf_counter() - started
+    random.Random(args.seed).shuffle(partners)
+
+    print(json.dumps({
+        'organizations': db.execute('SELECT COUNT(*) FROM organizations').fetchone()[0],
+        'closure_rows': db.execute('SELECT COUNT(*) FROM organizations_closure').fetchone()[0],
+        'build_sec': round(build_time, 2),
+        'recursive_cte_ms': round(measure(db, RECURSIVE_CTE, partners, args.queries), 3),
+        'closure_ms': round(measure(db, CLOSURE, partners, args.queries), 3),
+    }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=4, help='Levels of partners below the root')
+    parser.add_argument('--fanout', type=int, default=10, help='Child partners per partner')
+    parser.add_argument('--customers', type=int, default=10, help='Customers per leaf partner')
+    parser.add_argument('--queries', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Measures the validation of callback payloads with the compiled validators and with walking the schema on every request.
+# Run from the repository root: python -m benchmarks.payload_validation
+
+import json
+import random
+import argparse
+from uuid import UUID
+from timeit import timeit
+from typing import Any, Optional
+
+from constants import APPCODE
+from server.callbacks import PAYLOAD_VALIDATORS, REQUEST_SCHEMA, validate_request
+import server.callbacks.enablement as enablement
+import server.callbacks.user_management as user_management
+
+TENANT_MAPPING_WRITE = 'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.write.v1.0'
+USER_WRITE = f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_write.v1.0'
+SCHEMAS = {**enablement.schemas, **user_management.schemas}
+TYPES = {'object': dict, 'array': list, 'string': str, 'integer': int, 'number': (int, float), 'boolean': bool, 'null': type(None)}
+
+
+def interpret(schema: dict, value: Any, path: str = 'payload') -> Optional[str]:
+    """Validates by reading the schema on every call, as a generic validator does."""
+    if 'type' in schema:
+        names = [schema['type']] if isinstance(schema['type'], str) else schema['type']
+        if not any(isinstance(value, TYPES[name]) and not (isinstance(value, bool) and name in ('integer', 'number')) for name in names):
+            return f'{path} has a wrong type'
+    if isinstance(value, dict):
+        for name in schema.get('required', ()):
+            if name not in value:
+                return f'{path}.{name} is required'
+        for name, subschema in schema.get('properties', {}).items():
+            if name in value:
+                error = interpret(subschema, value[name], f'{path}.{name}')
+                if error:
+                    return error
+    if isinstance(value, list) and 'items' in schema:
+        for i, item in enumerate(value):
+            error = interpret(schema['items'], item, f'{path}[{i}]')
+            if error:
+                return error
+    return None
+
+
+def uuid(rng: random.Random) -> str:
+    return str(UUID(int=rng.getrandbits(128), version=4))
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    request = {
+        'type': 'cti.a.p.acgw.request.v1.0~a.p.tenant_mapping.write.v1.0',
+        'request_id': uuid(rng),
+        'created_at': '2024-01-01T00:00:00Z',
+        'context': {'callback_id': TENANT_MAPPING_WRITE, 'endpoint_id': 'endpoint', 'tenant_id': uuid(rng), 'datacenter_url': 'https://eu8-cloud.acronis.com'},
+    }
+    cases = [
+        ('request envelope', REQUEST_SCHEMA, validate_request, request),
+        ('user_write', SCHEMAS[USER_WRITE], PAYLOAD_VALIDATORS[USER_WRITE], {'login': 'john.doe', 'name': 'John Doe', 'email': 'john.doe@example.com'}),
+    ]
+    for items in args.items:
+        modified = [{'vendor_tenant_id': uuid(rng), 'acronis_tenant_id': uuid(rng) if rng.random() < 0.8 else None} for _ in range(items)]
+        cases.append((f'tenant_mapping.write, {items} items', SCHEMAS[TENANT_MAPPING_WRITE], PAYLOAD_VALIDATORS[TENANT_MAPPING_WRITE], {'modified': modified}))
+
+    for name, schema, validate, value in cases:
+        assert validate(value) is None and interpret(schema, value, 'request' if schema is REQUEST_SCHEMA else 'payload') is None
+        number = max(1, args.number // max(1, len(value.get('modified', ()))))
+        print(json.dumps({
+            'case': name,
+            'compiled_us': round(timeit(lambda: validate(value), number=number) / number * 10 ** 6, 3),
+            'interpreted_us': round(timeit(lambda: interpret(schema, value), number=number) / number * 10 ** 6, 3),
+        }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Compares the per-item and the set-based implementations of tenant_mapping.write on a large mapping
+# and checks that both leave the same mapping behind.
+# Run from the repository root: python -m benchmarks.tenant_mapping_write
+
+import json
+import random
+import sqlite3
+import argparse
+from time import perf_counter
+from typing import Optional
+
+from datatypes import OrganizationKind
+from utils import create_organizations_closure
+from server.callbacks.enablement import write_tenant_mapping
+
+PARTNER_ID = 'partner'
+DATACENTER_URL = 'https://dc.example.com'
+
+
+def per_item_write(conn: sqlite3.Connection, organization_id: str, datacenter_url: str, modified: list[dict]) -> Optional[str]:
+    """The implementation that checks and writes the items one by one."""
+    orgs = [
+        row[0] for row in conn.execute(
+            '''SELECT orgs.id
+            FROM organizations_closure AS tree
+            JOIN organizations AS orgs ON orgs.id = tree.descendant_id
+            WHERE tree.ancestor_id = ? AND tree.depth > 0 AND orgs.kind = ?''',
+            (organization_id, OrganizationKind.CUSTOMER)
+        ).fetchall()
+    ]
+    if not orgs:
+        return 'Nothing to map'
+    to_insert = []
+    for item in modified:
+        if item['vendor_tenant_id'] not in orgs:
+            conn.rollback()
+            return 'Failed to write the mapping.'
+        if 'acronis_tenant_id' not in item or not item['acronis_tenant_id']:
+            conn.execute('DELETE FROM organizations_mapping WHERE organization_id = ?', (item['vendor_tenant_id'],))
+            continue
+        conn.execute('DELETE FROM organizations_mapping WHERE acronis_tenant_id = ?', (item['acronis_tenant_id'],))
+        to_insert.append({'vendor_tenant_id': item['vendor_tenant_id'], 'acronis_tenant_id': item['acronis_tenant_id'], 'acronis_dc_url': datacenter_url})
+    conn.executemany('INSERT INTO organizations_mapping VALUES (:vendor_tenant_id, :acronis_tenant_id, :acronis_dc_url) ON CONFLICT(acronis_tenant_id) DO UPDATE SET organization_id = :vendor_tenant_id WHERE acronis_tenant_id = :acronis_tenant_id', to_insert)
+    return None
+
+
+def build_database(customers: int) -> sqlite3.Connection:
+    db = sqlite3.connect(':memory:')
+    db.execute('PRAGMA foreign_keys=ON')
+    db.execute('CREATE TABLE organizations (id VARCHAR(36) NOT NULL PRIMARY KEY, parent_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE, name VARCHAR(255), kind TINYINT) WITHOUT ROWID')
+    db.execute('CREATE TABLE organizations_mapping (organization_id VARCHAR(36) PRIMARY KEY REFERENCES organizations(id) ON DELETE CASCADE, acronis_tenant_id VARCHAR(36) UNIQUE, acronis_dc_url VARCHAR(64)) WITHOUT ROWID')
+    create_organizations_closure(db)
+    db.execute('INSERT INTO organizations VALUES (?,?,?,?)', (PARTNER_ID, None, PARTNER_ID, OrganizationKind.PARTNER))
+    db.executemany('INSERT INTO organizations VALUES (?,?,?,?)', ((f'c{i}', PARTNER_ID, f'c{i}', OrganizationKind.CUSTOMER) for i in range(customers)))
+    # Every other customer is already mapped
+    db.executemany('INSERT INTO organizations_mapping VALUES (?,?,?)', ((f'c{i}', f'a{i}', DATACENTER_URL) for i in range(0, customers, 2)))
+    db.commit()
+    return db
+
+
+def random_modified(customers: int, items: int, rng: random.Random) -> list[dict]:
+    """
+    Maps unmapped customers to Acronis tenants, some of which are taken over from mapped customers,
+    and unmaps some of the mapped customers.
+    """
+    unmapped = rng.sample(range(1, customers, 2), items - items // 10)
+    mapped = rng.sample(range(0, customers, 2), items // 10)
+    tenants = rng.sample(range(customers * 2), len(unmapped))
+    modified = [{'vendor_tenant_id': f'c{vendor}', 'acronis_tenant_id': f'a{tenant}'} for vendor, tenant in zip(unmapped, tenants)]
+    modified += [{'vendor_tenant_id': f'c{vendor}', 'acronis_tenant_id': ''} for vendor in mapped]
+    rng.shuffle(modified)
+    return modified
+
+
+def run(write, db: sqlite3.Connection, modified: list[dict]) -> tuple[float, list]:
+    started = perf_counter()
+    with db:
+        error = write(db, PARTNER_ID, DATACENTER_URL, modified)
+    elapsed = perf_counter() - started
+    assert error is None, error
+    return elapsed, db.execute('SELECT * FROM organizations_mapping ORDER BY organization_id').fetchall()
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    modified = random_modified(args.customers, args.items, rng)
+
+    per_item_time, per_item_result = run(per_item_write, build_database(args.customers), modified)
+    set_based_time, set_based_result = run(write_tenant_mapping, build_database(args.customers), modified)
+    assert per_item_result == set_based_result, 'Implementations produced different mappings'
+
+    print(json.dumps({
+        'customers': args.customers,
+        'items': args.items,
+        'per_item_sec': round(per_item_time, 3),
+        'set_based_sec': round(set_based_time, 3),
+    }))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args)
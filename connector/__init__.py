@@ -3,24 +3,109 @@
 # This source code is distributed under MIT software license.
 # ************************************************************
 
-import sqlite3
 import asyncio
 import logging
-from random import randint
-from datetime import datetime
+from time import monotonic
+from dataclasses import dataclass
+from typing import Optional
 
 from datatypes import OrganizationKind
+from server.database import Database
 from .generator import get_random_alert, get_random_workload
 from .api_client import ApiClient
+from .rate_limit import TokenBucket
+from .batching import WorkloadBatcher
+from .outbox import Outbox
+from .delivery import deliver
+from .stats import DeliveryStats
+from .scheduler import TenantScheduler
+from .changes import ChangeFeed, ChangesLost
 
 POST_INTERVAL = 1800 * 1000 # 30 minutes in millis
 
+# Alerts written to the outbox in one transaction
+ENQUEUE_CHUNK = 500
 
-async def backoff():
-    return await asyncio.sleep(randint(50, 250) / 1000) # Between 50 and 250 millis
 
+@dataclass
+class ConnectorSettings:
+    workers: int = 16                # posts in flight at the same time per endpoint
+    alerts_rate: float = 10          # alert posts per second, 0 for no limit
+    workloads_rate: float = 10       # workload posts per second, 0 for no limit
+    batch_size: int = 100            # workloads posted in one request
+    batch_delay: float = 1.0         # seconds a workload may wait for its batch to fill up
+    delivery_attempts: int = 8       # attempts to post an outbox item before it's moved to the dead letters
+    mapping_refresh: float = 10      # seconds between checks for tenant mapping changes
+    stats_interval: float = 60       # seconds between the statistics log records
 
-async def connector(db: sqlite3.Connection, client: ApiClient):
+
+async def enqueue_tenants(outbox: Outbox, batcher: WorkloadBatcher, tenants: list[str]) -> None:
+    """Queues an alert for every tenant and hands the tenants' workloads to the batcher."""
+    alerts = []
+    for tenant_id in tenants:
+        alert = get_random_alert(tenant_id)
+        logging.debug('Alert data: %s', alert)
+        alerts.append(alert)
+        if len(alerts) >= ENQUEUE_CHUNK:
+            await outbox.enqueue('alerts', alerts)
+            alerts = []
+
+        workload = get_random_workload(tenant_id)
+        logging.debug('Workload data: %s', workload)
+        await batcher.add(workload['items'])
+    if alerts:
+        await outbox.enqueue('alerts', alerts)
+
+
+async def read_tenants(db: Database, organization_ids: Optional[set[str]] = None) -> dict[str, str]:
+    """Returns the Acronis tenants of all the mapped customers or only of the given organizations by organization id."""
+    sql = 'SELECT organization_id, acronis_tenant_id FROM organizations_mapping AS map JOIN organizations AS orgs ON orgs.id = map.organization_id WHERE kind = ?'
+    params = (OrganizationKind.CUSTOMER,)
+    if organization_ids is not None:
+        sql += f' AND organization_id IN ({",".join("?" * len(organization_ids))})'
+        params += tuple(organization_ids)
+    return {row['organization_id']: row['acronis_tenant_id'] for row in await db.fetchall(sql, params)}
+
+
+async def apply_changes(db: Database, feed: ChangeFeed, scheduler: TenantScheduler, tenants: dict[str, str]) -> tuple[int, int]:
+    """
+    Updates the scheduled tenants and the `tenants` by organization id with the organizations changed since the last call,
+    returns the number of tenants added and removed. If some changes were pruned before they were read, all organizations
+    are compared with the full mapping.
+    """
+    added = removed = 0
+    while True:
+        try:
+            changes = await feed.read()
+        except ChangesLost as e:
+            logging.info('%s, reading the full tenant mapping', e)
+            await feed.skip()
+            current = await read_tenants(db)
+            organization_ids = set(tenants) | set(current)
+        else:
+            if not changes:
+                break
+            organization_ids = {change.row_id for change in changes if change.table_name in ('organizations', 'organizations_mapping')}
+            current = await read_tenants(db, organization_ids) if organization_ids else {}
+        if organization_ids:
+            changed = [org_id for org_id in organization_ids if tenants.get(org_id) != current.get(org_id)]
+            # A tenant may move to another organization, so it's removed from the old one before it's added to the new one
+            for org_id in changed:
+                if org_id in tenants:
+                    scheduler.remove(tenants.pop(org_id))
+                    removed += 1
+            for org_id in changed:
+                if org_id in current:
+                    tenants[org_id] = current[org_id]
+                    scheduler.add(current[org_id])
+                    added += 1
+        await feed.commit()
+    await feed.keep_alive()
+    return added, removed
+
+
+async def connector(db: Database, client: ApiClient, settings: Optional[ConnectorSettings] = None):
+    settings = settings or ConnectorSettings()
     logging.info('Starting up the connector...')
 
     logging.info('Authenticating...')
@@ -31,33 +116,75 @@ async def connector(db: sqlite3.Connection, client: ApiClient):
         return
     logging.info('Successfully authenticated in Acronis!')
 
-    last_post_time = int(datetime.utcnow().timestamp() * 1000) - POST_INTERVAL
-    while True:
-        now = int(datetime.utcnow().timestamp() * 1000)
-        if now - last_post_time < POST_INTERVAL:
-            await asyncio.sleep(1)
-            continue
-        last_post_time = int(datetime.utcnow().timestamp() * 1000)
-
-        logging.info('Got new data! Posting to Acronis...')
-        mapping = db.execute('SELECT acronis_tenant_id FROM organizations_mapping AS map LEFT JOIN organizations AS orgs ON orgs.id = map.organization_id WHERE kind = ?', (OrganizationKind.CUSTOMER,)).fetchall()
-        for item in mapping:
-            logging.info(f'Posting to {item["acronis_tenant_id"]}...')
-            alert = get_random_alert(item["acronis_tenant_id"])
-            logging.info(f'Alert data: {alert}')
-            try:
-                data = await client.post_alerts(alert)
-                logging.info(f'Done! Response: {data}')
-                await backoff()
-            except Exception as e:
-                logging.info(e)
-
-            workload = get_random_workload(item["acronis_tenant_id"])
-            logging.info(f'Workload data: {workload}')
-            try:
-                await client.post_devices(workload)
-                logging.info(f'Done!')
-                await backoff()
-            except Exception as e:
-                logging.info(e)
-        logging.info('Finished posting.')
+    outbox = Outbox(db, settings.delivery_attempts)
+
+    async def send_alert(payload: dict, idempotency_key: str):
+        response = await client.post_alerts(payload, idempotency_key)
+        logging.debug('Done! Response: %s', response)
+
+    async def send_workloads(payload: dict, idempotency_key: str):
+        failed = await client.post_workloads(payload['items'], idempotency_key)
+        stats.count_workloads('ok', len(payload['items']) - len(failed))
+        stats.count_workloads('requeued', len(failed))
+        return {'items': failed} if failed else None
+
+    stats = DeliveryStats()
+    senders = {
+        'alerts': (send_alert, TokenBucket(settings.alerts_rate)),
+        'workloads': (send_workloads, TokenBucket(settings.workloads_rate)),
+    }
+    deliveries = [
+        asyncio.create_task(deliver(outbox, endpoint, send, bucket, stats))
+        for endpoint, (send, bucket) in senders.items()
+        for _ in range(max(1, settings.workers))
+    ]
+
+    async def enqueue_workloads(items: list[dict]):
+        await outbox.enqueue('workloads', [{'items': items}])
+
+    # The full mapping is read once, after that only the organizations in the change log are read again
+    feed = ChangeFeed(db, 'connector')
+    await feed.start()
+    await feed.skip()
+    tenants = await read_tenants(db)
+    scheduler = TenantScheduler(POST_INTERVAL / 1000)
+    scheduler.sync(tenants.values())
+    logging.info('Scheduled %d tenants', len(scheduler))
+
+    next_sync = monotonic() + settings.mapping_refresh
+    next_stats = next_sync + settings.stats_interval
+    posted = 0
+    try:
+        async with WorkloadBatcher(enqueue_workloads, settings.batch_size, settings.batch_delay) as batcher:
+            while True:
+                now = monotonic()
+                if now >= next_sync:
+                    try:
+                        added, removed = await apply_changes(db, feed, scheduler, tenants)
+                    except Exception as e:
+                        logging.info('Failed to read the tenant mapping changes: %s', e)
+                    else:
+                        if added or removed:
+                            logging.info('Tenants changed: %d added, %d removed, %d scheduled', added, removed, len(scheduler))
+                    next_sync = now + settings.mapping_refresh
+
+                due = scheduler.pop_due()
+                if due:
+                    await enqueue_tenants(outbox, batcher, due)
+                    posted += len(due)
+
+                if now >= next_stats:
+                    report = {'tenants': len(scheduler), 'tenants_queued': posted, 'deliveries': stats.take(), 'outbox': await outbox.stats()}
+                    logging.info('Connector stats: %s', report, extra={'cycle': report})
+                    posted = 0
+                    next_stats = now + settings.stats_interval
+
+                wake = min(next_sync, next_stats)
+                next_due = scheduler.next_due()
+                if next_due is not None:
+                    wake = min(wake, next_due)
+                await asyncio.sleep(max(0.0, wake - monotonic()))
+    finally:
+        for task in deliveries:
+            task.cancel()
+        await asyncio.gather(*deliveries, return_exceptions=True)
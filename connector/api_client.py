@@ -3,11 +3,21 @@
 # This source code is distributed under MIT software license.
 # ************************************************************
 
+import asyncio
+import logging
 import aiohttp
+from time import time, monotonic
 from base64 import b64encode
+from email.utils import parsedate_to_datetime
 from typing import Optional, TypedDict
 
 
+# Tokens are refreshed in the background when this share of their lifetime has passed
+REFRESH_SHARE = 0.8
+# Seconds to wait before repeating a failed background refresh
+REFRESH_RETRY = 10
+
+
 class OAuth2TokenInfo(TypedDict):
     token_type: str
     access_token: str
@@ -16,13 +26,56 @@ class OAuth2TokenInfo(TypedDict):
     refresh_token: Optional[str]
 
 
+class RateLimited(Exception):
+    """The endpoint answered 429, `retry_after` is how many seconds it asked to wait, if it did."""
+
+    def __init__(self, url: str, retry_after: Optional[float]) -> None:
+        super().__init__(f'Rate limited by {url}, retry after {retry_after} s')
+        self.retry_after = retry_after
+
+
+def _retry_after(res: aiohttp.ClientResponse) -> Optional[float]:
+    value = res.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _idempotency_headers(idempotency_key: Optional[str]) -> Optional[dict]:
+    return {'Idempotency-Key': idempotency_key} if idempotency_key else None
+
+
+def _raise_for_status(res: aiohttp.ClientResponse) -> None:
+    if res.status == 429:
+        res.release()
+        raise RateLimited(str(res.url), _retry_after(res))
+    res.raise_for_status()
+
+
 class ApiClient:
+    """
+    Acronis API client authenticated with the client credentials.
+
+    The access token is refreshed in the background before it expires. A request answered with 401 fetches a new
+    token and is repeated once with it. Requests that fail at the same time share one token fetch.
+    """
 
     def __init__(self, dc_url: str, client_id: str, client_secret: str) -> None:
         self.dc_url = dc_url.rstrip('/')
         self.client_id = client_id
         self.client_secret = client_secret
         self.session: aiohttp.ClientSession = None
+        self._token_lock = asyncio.Lock()
+        self._token_version = 0
+        self._expires_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
 
 
     async def __aenter__(self):
@@ -31,32 +84,91 @@ class ApiClient:
 
 
     async def __aexit__(self, *error_details): 
+        if self._refresh_task:
+            self._refresh_task.cancel()
         await self.session.close()
 
 
     async def authenticate(self) -> OAuth2TokenInfo:
+        """Fetches an access token and keeps refreshing it before it expires."""
+        async with self._token_lock:
+            return await self._fetch_token()
+
+
+    async def _fetch_token(self) -> OAuth2TokenInfo:
         encoded_client_creds = b64encode(f'{self.client_id}:{self.client_secret}'.encode('ascii'))
         headers = {'Authorization': f'Basic {encoded_client_creds.decode("ascii")}'}
         res = await self.session.post(f'{self.dc_url}/bc/idp/token', headers=headers, data={'grant_type': 'client_credentials'})
         res.raise_for_status()
         token_info: OAuth2TokenInfo = await res.json()
         self.session.headers['Authorization'] = f'Bearer {token_info["access_token"]}'
+        self._token_version += 1
+
+        expires_in = token_info.get('expires_in')
+        self._expires_at = monotonic() + expires_in if expires_in else None
+        if self._refresh_task and self._refresh_task is not asyncio.current_task():
+            self._refresh_task.cancel()
+        if expires_in:
+            self._refresh_task = asyncio.create_task(self._refresh_later(expires_in * REFRESH_SHARE))
         return token_info
 
 
-    async def post_alerts(self, alert: dict) -> dict:
-        res = await self.session.post(
+    async def _refresh_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        while True:
+            try:
+                await self._reauthenticate(self._token_version)
+                return
+            except Exception as e:
+                logging.info('Failed to refresh the access token: %s', e)
+                await asyncio.sleep(REFRESH_RETRY)
+
+
+    async def _reauthenticate(self, version: int) -> None:
+        """Fetches a new token unless the token of `version` was replaced already while waiting for the lock."""
+        async with self._token_lock:
+            if self._token_version == version:
+                await self._fetch_token()
+
+
+    async def _post(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        version = self._token_version
+        if self._expires_at is not None and monotonic() >= self._expires_at:
+            await self._reauthenticate(version)
+            version = self._token_version
+        res = await self.session.post(url, **kwargs)
+        if res.status == 401:
+            res.release()
+            await self._reauthenticate(version)
+            res = await self.session.post(url, **kwargs)
+        return res
+
+
+    async def post_alerts(self, alert: dict, idempotency_key: Optional[str] = None) -> dict:
+        res = await self._post(
             f'{self.dc_url}/api/alert_manager/v1/alerts',
-            json=alert
+            json=alert,
+            headers=_idempotency_headers(idempotency_key)
         )
-        res.raise_for_status()
+        _raise_for_status(res)
         return await res.json()
 
 
-    async def post_devices(self, workload: dict) -> None:
-        res = await self.session.post(
+    async def post_workloads(self, items: list[dict], idempotency_key: Optional[str] = None) -> list[dict]:
+        """
+        Posts the workloads of any number of tenants in one request and returns the items that were not accepted.
+
+        A `207 Multi-Status` answer lists a result for every item in request order, an item whose result has an `error`
+        or a failing `status` is returned. Any other successful answer means all the items were accepted.
+        """
+        res = await self._post(
             f'{self.dc_url}/api/workload_management/v5/workloads',
-            json=workload
+            json={'items': items},
+            headers=_idempotency_headers(idempotency_key)
         )
-        res.raise_for_status()
-        return
+        _raise_for_status(res)
+        if res.status != 207:
+            res.release()
+            return []
+        results = (await res.json()).get('items') or []
+        return [item for item, result in zip(items, results) if result.get('error') or result.get('status', 200) >= 400]
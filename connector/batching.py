@@ -0,0 +1,74 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+
+
+class WorkloadBatcher:
+    """
+    Collects the workloads of many tenants and hands them over in batches.
+
+    A batch is flushed when `max_size` items are pending or the oldest of them waited `max_delay` seconds.
+    `add` waits while too many items are pending, so producers can't outrun the flushing.
+    Leaving the `async with` block flushes everything still pending.
+    """
+
+    def __init__(self, flush: Callable[[list[dict]], Awaitable[None]], max_size: int = 100, max_delay: float = 1.0) -> None:
+        self.flush = flush
+        self.max_size = max(1, max_size)
+        self.max_delay = max_delay
+        self.pending: list[dict] = []
+        self.oldest: Optional[float] = None
+        self._changed = asyncio.Condition()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+
+    async def __aexit__(self, *error_details):
+        async with self._changed:
+            self._closing = True
+            self._changed.notify_all()
+        await self._task
+
+
+    async def add(self, items: list[dict]) -> None:
+        async with self._changed:
+            await self._changed.wait_for(lambda: len(self.pending) < self.max_size * 4)
+            if items and not self.pending:
+                self.oldest = monotonic()
+            self.pending.extend(items)
+            self._changed.notify_all()
+
+
+    def _due(self) -> bool:
+        return len(self.pending) >= self.max_size or (self._closing and bool(self.pending))
+
+
+    async def _run(self) -> None:
+        while True:
+            async with self._changed:
+                while not self._due():
+                    if self._closing and not self.pending:
+                        return
+                    if self.pending and monotonic() - self.oldest >= self.max_delay:
+                        break
+                    timeout = self.max_delay - (monotonic() - self.oldest) if self.pending else None
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                batch = self.pending[:self.max_size]
+                del self.pending[:self.max_size]
+                self.oldest = monotonic() if self.pending else None
+                self._changed.notify_all()
+
+            await self.flush(batch)
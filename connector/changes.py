@@ -0,0 +1,100 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sqlite3
+from time import time, monotonic
+from typing import NamedTuple
+
+from utils import prune_change_log, CHANGE_LOG_RETENTION
+from server.database import Database
+
+# Changes read from the log at once
+CHANGES_CHUNK = 1000
+
+
+class Change(NamedTuple):
+    id: int
+    table_name: str
+    row_id: str
+    operation: str
+
+
+class ChangesLost(Exception):
+    pass
+
+
+def _last_change_id(conn: sqlite3.Connection) -> int:
+    # Unlike MAX(id), the sequence isn't reset when the log is emptied by pruning
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row['seq'] if row else 0
+
+
+def _read_changes(conn: sqlite3.Connection, position: int, limit: int) -> list[sqlite3.Row]:
+    # Both reads see the same snapshot, otherwise a change committed between them would look like a pruned one
+    conn.execute('BEGIN')
+    try:
+        rows = conn.execute('SELECT id, table_name, row_id, operation FROM change_log WHERE id > ? ORDER BY id LIMIT ?', (position, limit)).fetchall()
+        # Ids have no gaps, except where changes were pruned
+        first = rows[0]['id'] if rows else _last_change_id(conn) + 1
+    finally:
+        conn.commit()
+    if first > position + 1:
+        raise ChangesLost(f'Changes {position + 1} to {first - 1} were pruned before they were read')
+    return rows
+
+
+class ChangeFeed:
+    """
+    Reads the `change_log` on behalf of the `consumer` from the last change it committed.
+
+    `read` returns the next changes after the current position and moves it forward, `commit` saves the position,
+    so a restarted consumer continues where it stopped. Changes that every active consumer has committed and changes
+    older than `CHANGE_LOG_RETENTION` are deleted. `read` raises `ChangesLost` if changes after the position were
+    deleted before the consumer read them, the consumer then has to `skip` and read the current state in full.
+    """
+
+    def __init__(self, db: Database, consumer: str) -> None:
+        self.db = db
+        self.consumer = consumer
+        self.position = 0
+        self.committed = monotonic()
+
+
+    async def start(self) -> None:
+        """Loads the saved position."""
+        row = await self.db.fetchone('SELECT last_id FROM change_log_consumers WHERE name = ?', (self.consumer,))
+        if row is not None:
+            self.position = row['last_id']
+
+
+    async def skip(self) -> None:
+        """
+        Moves the position to the latest change, for a consumer that is about to read the current state in full.
+        Changes made while it reads are read again afterwards, so applying a change must be safe to repeat.
+        """
+        self.position = await self.db.read(_last_change_id)
+        await self.commit()
+
+
+    async def read(self, limit: int = CHANGES_CHUNK) -> list[Change]:
+        rows = await self.db.read(_read_changes, self.position, limit)
+        if rows:
+            self.position = rows[-1]['id']
+        return [Change(*row) for row in rows]
+
+
+    async def commit(self) -> None:
+        def commit(conn: sqlite3.Connection):
+            now = int(time())
+            conn.execute('INSERT OR REPLACE INTO change_log_consumers (name, last_id, updated_at) VALUES (?,?,?)', (self.consumer, self.position, now))
+            prune_change_log(conn, now)
+        await self.db.write(commit)
+        self.committed = monotonic()
+
+
+    async def keep_alive(self) -> None:
+        """Saves the position if it wasn't saved for half of the retention, so a consumer without new changes isn't taken for idle."""
+        if monotonic() - self.committed >= CHANGE_LOG_RETENTION / 2:
+            await self.commit()
@@ -0,0 +1,56 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import asyncio
+import logging
+from time import time
+from typing import Awaitable, Callable, Optional
+
+from .api_client import RateLimited
+from .rate_limit import TokenBucket
+from .outbox import Outbox
+from .stats import DeliveryStats
+
+# Items an idle delivery worker takes from the outbox at once
+CLAIM_SIZE = 10
+
+# Posts an item's payload with its idempotency key, returns the part of the payload the server didn't accept, if any
+Send = Callable[[dict, str], Awaitable[Optional[dict]]]
+
+
+async def deliver(outbox: Outbox, endpoint: str, send: Send, bucket: TokenBucket, stats: DeliveryStats) -> None:
+    """Posts the endpoint's outbox items as they become due, until cancelled."""
+    while True:
+        try:
+            items = await outbox.claim(endpoint, CLAIM_SIZE)
+            if not items:
+                await outbox.wait(endpoint)
+                continue
+
+            for item in items:
+                await bucket.acquire()
+                try:
+                    remainder = await send(item.payload, item.idempotency_key)
+                except RateLimited as e:
+                    stats.count(endpoint, 'rate_limited')
+                    bucket.throttle(e.retry_after)
+                    await outbox.failed(item, str(e), e.retry_after or 1.0)
+                except Exception as e:
+                    stats.count(endpoint, 'failed')
+                    if await outbox.failed(item, str(e)):
+                        logging.info('Gave up posting %s to %s after %d attempts: %s', item.idempotency_key, endpoint, item.attempts, e)
+                    else:
+                        logging.info('Failed to post %s to %s, attempt %d: %s', item.idempotency_key, endpoint, item.attempts, e)
+                else:
+                    bucket.succeeded()
+                    stats.count(endpoint, 'partial' if remainder else 'ok')
+                    if not remainder:
+                        stats.delivered(time() - item.created_at)
+                    await outbox.delivered(item, remainder)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.info('Delivering to %s failed: %s', endpoint, e)
+            await asyncio.sleep(1)
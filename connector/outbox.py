@@ -0,0 +1,148 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import json
+import random
+import sqlite3
+import asyncio
+from time import time
+from uuid import uuid4
+from typing import NamedTuple, Optional
+
+from server.database import Database
+
+# Seconds a claimed item stays invisible to other deliveries, it's delivered again if not settled by then, also when
+# the process that claimed it stopped
+CLAIM_LEASE = 600
+
+
+class OutboxItem(NamedTuple):
+    id: int
+    endpoint: str
+    idempotency_key: str
+    payload: dict
+    attempts: int
+    created_at: float
+
+
+class Outbox:
+    """
+    Durable queue of requests to Acronis kept in the connector's database.
+
+    The tables are created by the `Connector outbox` migration. Due items are found by (endpoint, available_at). A
+    claim pushes `available_at` forward by `CLAIM_LEASE`, so several processes can deliver from the same outbox and
+    claiming a batch reads only the rows it takes.
+
+    Items are delivered at least once: an item is deleted only after it was delivered, and one that was claimed by a
+    process that stopped is claimed again when its lease expires. Every item has an idempotency key that is sent with
+    each of its attempts. Failed items are retried with exponential backoff and jitter and moved to
+    `connector_outbox_dead` after `max_attempts` attempts.
+    """
+
+    def __init__(self, db: Database, max_attempts: int = 8, base_backoff: float = 1.0, max_backoff: float = 600) -> None:
+        self.db = db
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._added: dict[str, asyncio.Event] = {}
+
+
+    async def enqueue(self, endpoint: str, payloads: list[dict], attempts: int = 0, delay: float = 0) -> None:
+        now = time()
+        rows = [(endpoint, str(uuid4()), json.dumps(payload), attempts, now, now + delay) for payload in payloads]
+
+        def enqueue(conn: sqlite3.Connection):
+            conn.executemany(
+                'INSERT INTO connector_outbox (endpoint, idempotency_key, payload, attempts, created_at, available_at) VALUES (?,?,?,?,?,?)', rows)
+        await self.db.write(enqueue)
+        self._event(endpoint).set()
+
+
+    async def claim(self, endpoint: str, limit: int) -> list[OutboxItem]:
+        """Takes up to `limit` due items of the endpoint, oldest first."""
+        now = time()
+        rows = await self.db.write(lambda conn: conn.execute(
+            '''UPDATE connector_outbox SET attempts = attempts + 1, available_at = ?
+            WHERE id IN (SELECT id FROM connector_outbox WHERE endpoint = ? AND available_at <= ? ORDER BY available_at LIMIT ?)
+            RETURNING id, endpoint, idempotency_key, payload, attempts, created_at''', (now + CLAIM_LEASE, endpoint, now, limit)).fetchall())
+        items = [OutboxItem(row['id'], row['endpoint'], row['idempotency_key'], json.loads(row['payload']), row['attempts'], row['created_at']) for row in rows]
+        return sorted(items, key=lambda item: item.id)
+
+
+    async def delivered(self, item: OutboxItem, remainder: Optional[dict] = None) -> None:
+        """Removes a delivered item. `remainder` is the part of it the server didn't accept, it's queued as a new item."""
+        def delivered(conn: sqlite3.Connection):
+            conn.execute('DELETE FROM connector_outbox WHERE id = ?', (item.id,))
+            if remainder is not None:
+                now = time()
+                conn.execute(
+                    'INSERT INTO connector_outbox (endpoint, idempotency_key, payload, attempts, created_at, available_at) VALUES (?,?,?,?,?,?)',
+                    (item.endpoint, str(uuid4()), json.dumps(remainder), item.attempts, item.created_at, now + self.backoff(item.attempts)))
+        await self.db.write(delivered)
+
+
+    async def failed(self, item: OutboxItem, error: str, retry_after: Optional[float] = None) -> bool:
+        """
+        Schedules the next attempt of a failed item, or moves it to the dead letters if it has no attempts left.
+        An item that was only rate limited with `retry_after` doesn't use up an attempt. Returns whether the item is dead.
+        """
+        attempts = item.attempts if retry_after is None else item.attempts - 1
+        dead = attempts >= self.max_attempts
+
+        def failed(conn: sqlite3.Connection):
+            now = time()
+            if dead:
+                conn.execute(
+                    '''INSERT INTO connector_outbox_dead (endpoint, idempotency_key, payload, attempts, created_at, failed_at, last_error)
+                    SELECT endpoint, idempotency_key, payload, attempts, created_at, ?, ? FROM connector_outbox WHERE id = ?''', (now, error, item.id))
+                conn.execute('DELETE FROM connector_outbox WHERE id = ?', (item.id,))
+            else:
+                delay = self.backoff(attempts) if retry_after is None else retry_after
+                conn.execute(
+                    'UPDATE connector_outbox SET attempts = ?, available_at = ?, last_error = ? WHERE id = ?',
+                    (attempts, now + delay, error, item.id))
+        await self.db.write(failed)
+        return dead
+
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds to wait before the next attempt: doubles with every attempt, the second half of it is random."""
+        delay = min(self.max_backoff, self.base_backoff * 2 ** max(0, attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    async def wait(self, endpoint: str, max_wait: float = 5.0) -> None:
+        """Waits until an item of the endpoint may be due: something was enqueued or the earliest item's time came."""
+        event = self._event(endpoint)
+        event.clear()
+        row = await self.db.fetchone('SELECT MIN(available_at) FROM connector_outbox WHERE endpoint = ?', (endpoint,))
+        delay = max_wait if row[0] is None else min(max_wait, max(0.0, row[0] - time()))
+        # Unlike `wait_for`, `wait` never swallows a cancellation that comes together with the event
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait([waiter], timeout=delay)
+        finally:
+            waiter.cancel()
+
+
+    async def stats(self) -> dict:
+        """Returns the number of queued items and the age of the oldest one in seconds by endpoint, and the number of dead items."""
+        def stats(conn: sqlite3.Connection):
+            now = time()
+            # The count is read from the due index, the oldest item of each endpoint with one lookup in the creation index
+            queued = {}
+            for endpoint, depth in conn.execute('SELECT endpoint, COUNT(*) FROM connector_outbox GROUP BY endpoint').fetchall():
+                oldest = conn.execute('SELECT MIN(created_at) FROM connector_outbox WHERE endpoint = ?', (endpoint,)).fetchone()[0]
+                queued[endpoint] = {'depth': depth, 'oldest_sec': round(now - oldest, 1)}
+            dead = conn.execute('SELECT COUNT(*) FROM connector_outbox_dead').fetchone()[0]
+            return {'queued': queued, 'dead': dead}
+        return await self.db.read(stats)
+
+
+    def _event(self, endpoint: str) -> asyncio.Event:
+        event = self._added.get(endpoint)
+        if event is None:
+            event = self._added[endpoint] = asyncio.Event()
+        return event
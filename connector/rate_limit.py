@@ -0,0 +1,70 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import asyncio
+from time import monotonic
+from typing import Optional
+
+# The rate is never throttled below this share of the configured one
+MIN_RATE_SHARE = 0.05
+# Share of the configured rate that is given back after every successful request
+RECOVERY_SHARE = 0.01
+
+
+class TokenBucket:
+    """
+    Limits the request rate to an endpoint, shared by all the workers posting to it.
+
+    Up to `burst` requests may go at once, after that they are spaced out at `rate` per second. Waiters are served
+    in arrival order. When the endpoint answers 429, `throttle` pauses the bucket for the `Retry-After` time and
+    halves the rate, which then recovers a little with every successful request. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                if self.max_rate <= 0:
+                    return
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+    def throttle(self, retry_after: Optional[float] = None) -> None:
+        """Slows the bucket down after a 429 response, pausing it for `retry_after` seconds if the server said so."""
+        now = monotonic()
+        pause = 1.0
+        if self.max_rate > 0:
+            # Requests sent before the first 429 was seen may be rejected too, they don't slow the bucket down again
+            if now >= self.paused_until:
+                self.rate = max(self.max_rate * MIN_RATE_SHARE, self.rate / 2)
+            self.tokens = 0
+            pause = 1 / self.rate
+        if retry_after is not None:
+            pause = retry_after
+        self.paused_until = max(self.paused_until, now + pause)
+        self.updated = max(self.updated, self.paused_until)
+
+
+    def succeeded(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_SHARE)
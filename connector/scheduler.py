@@ -0,0 +1,81 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import random
+from time import monotonic
+from heapq import heappush, heappop, heapify
+from typing import Iterable, Optional
+
+
+class TenantScheduler:
+    """
+    Keeps the time every tenant is due to be posted to next, in a heap ordered by that time.
+
+    A new tenant is first due at a random moment within the interval, so the tenants are spread evenly over it,
+    and after that once per interval. Removed tenants leave stale heap entries behind, they are skipped when they
+    come up.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._heap: list[tuple[float, str]] = []
+        self._due: dict[str, float] = {}
+
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+
+    def add(self, tenant_id: str) -> None:
+        if tenant_id not in self._due:
+            self._push(tenant_id, monotonic() + random.uniform(0, self.interval))
+
+
+    def remove(self, tenant_id: str) -> None:
+        self._due.pop(tenant_id, None)
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._heap = [(due, tenant_id) for tenant_id, due in self._due.items()]
+            heapify(self._heap)
+
+
+    def sync(self, tenants: Iterable[str]) -> tuple[int, int]:
+        """Schedules the tenants that are new and drops the ones that are gone, returns how many were added and removed."""
+        tenants = set(tenants)
+        removed = self._due.keys() - tenants
+        for tenant_id in removed:
+            self.remove(tenant_id)
+        added = tenants - self._due.keys()
+        for tenant_id in added:
+            self.add(tenant_id)
+        return len(added), len(removed)
+
+
+    def pop_due(self) -> list[str]:
+        """Returns the tenants that are due now and schedules them for the next interval."""
+        now = monotonic()
+        tenants = []
+        while self._heap and self._heap[0][0] <= now:
+            due, tenant_id = heappop(self._heap)
+            if self._due.get(tenant_id) != due:
+                continue
+            tenants.append(tenant_id)
+            due += self.interval
+            if due <= now:
+                # Fell a whole interval behind, e.g. the process was suspended, spread the tenant out again
+                due = now + random.uniform(0, self.interval)
+            self._push(tenant_id, due)
+        return tenants
+
+
+    def next_due(self) -> Optional[float]:
+        """Returns the `monotonic()` time the next tenant is due at, None if there are no tenants."""
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+
+    def _push(self, tenant_id: str, due: float) -> None:
+        self._due[tenant_id] = due
+        heappush(self._heap, (due, tenant_id))
@@ -0,0 +1,55 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+from time import monotonic
+
+from utils import percentile
+
+
+class DeliveryStats:
+    """
+    Requests by endpoint and result, batched workloads by result and how long delivered items waited in the outbox,
+    counted since the last `take()`.
+    """
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        self.posts: dict[str, dict[str, int]] = {}
+        self.workloads: dict[str, int] = {}
+        self.latencies: list[float] = []
+
+
+    def count(self, endpoint: str, result: str) -> None:
+        counts = self.posts.setdefault(endpoint, {})
+        counts[result] = counts.get(result, 0) + 1
+
+
+    def count_workloads(self, result: str, n: int) -> None:
+        if n:
+            self.workloads[result] = self.workloads.get(result, 0) + n
+
+
+    def delivered(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+
+    def take(self) -> dict:
+        """Returns the counts and the throughput since the last call and starts counting anew."""
+        duration = monotonic() - self.started
+        posted = sum(counts.get('ok', 0) + counts.get('partial', 0) for counts in self.posts.values())
+        result = {
+            'duration_sec': round(duration, 2),
+            'posts_per_sec': round(posted / duration, 2) if duration else 0,
+            'posts': self.posts,
+            'workloads': self.workloads,
+            'delivery_p50_sec': round(percentile(self.latencies, 0.50), 3),
+            'delivery_p95_sec': round(percentile(self.latencies, 0.95), 3),
+            'delivery_max_sec': round(max(self.latencies, default=0), 3),
+        }
+        self.started = monotonic()
+        self.posts = {}
+        self.workloads = {}
+        self.latencies = []
+        return result
@@ -6,36 +6,125 @@
 # ************************************************************
 
 import names
+import random
+import sqlite3
 import argparse
 import logging
+import itertools
 from os.path import exists, dirname, realpath, join
 from uuid import uuid4
 from getpass import getpass
 
 from constants import ROOT_USER_ID, ROOT_ORGANIZATION_ID
 from utils import hash, sqlite_connect
+from migrations import migrate
 from datatypes import OrganizationKind
 
 logging.basicConfig(format='[create_db.py] %(asctime)s -- %(message)s', encoding='utf-8', level=logging.INFO)
 
+def backfill(filename: str):
+    if not exists(filename):
+        logging.error(f'{filename} does not exist.')
+        return
+
+    logging.info(f'Migrating {filename}...')
+    db = sqlite_connect(filename)
+    migrate(db)
+    db.close()
+    logging.info(f'Done.')
+
+
+def create_tables(db: sqlite3.Connection) -> None:
+    db.execute('CREATE TABLE IF NOT EXISTS users (id VARCHAR(36) NOT NULL PRIMARY KEY, login NVARCHAR(255) UNIQUE, name NVARCHAR(255), email VARCHAR(255), password VARCHAR(255), organization_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE) WITHOUT ROWID')
+
+    db.execute('CREATE TABLE IF NOT EXISTS organizations (id VARCHAR(36) NOT NULL PRIMARY KEY, parent_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE, name VARCHAR(255), kind TINYINT) WITHOUT ROWID')
+    db.execute('CREATE TABLE IF NOT EXISTS organizations_mapping (organization_id VARCHAR(36) PRIMARY KEY REFERENCES organizations(id) ON DELETE CASCADE, acronis_tenant_id VARCHAR(36) UNIQUE, acronis_dc_url VARCHAR(64)) WITHOUT ROWID')
+
+
+def generate(filename: str, args):
+    """
+    Fills a new database with a synthetic partner tree for benchmarks. The same seed always gives the same data.
+
+    The root partner has `depth` levels of sub-partners with `fan_out` children each, `customers` customers are spread
+    randomly over all partners, and every organization gets `users_per_org` users without passwords. A `mapped_ratio`
+    share of customers is mapped to Acronis tenants. Indexes and the organizations closure are built after the rows
+    are loaded, with journaling and foreign keys off while loading.
+    """
+    rng = random.Random(args.seed)
+
+    def uuid() -> str:
+        # Same as str(UUID(int=rng.getrandbits(128), version=4)), without the UUID object
+        bits = rng.getrandbits(128) & ~(0xf000 << 64) & ~(0xc000 << 48) | (0x4000 << 64) | (0x8000 << 48)
+        h = '%032x' % bits
+        return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+    partners = [(ROOT_ORGANIZATION_ID, None, 'John Doe Inc.', OrganizationKind.PARTNER)]
+    level = [ROOT_ORGANIZATION_ID]
+    for depth in range(1, args.depth + 1):
+        children = []
+        for parent_id in level:
+            for _ in range(args.fan_out):
+                children.append(uuid())
+                partners.append((children[-1], parent_id, f'Partner {len(partners)} Inc.', OrganizationKind.PARTNER))
+        level = children
+
+    partner_ids = [row[0] for row in partners]
+    customers = [(uuid(), rng.choice(partner_ids), f'Customer {i} Inc.', OrganizationKind.CUSTOMER) for i in range(args.customers)]
+    mappings = [(row[0], uuid(), args.datacenter_url) for row in customers if rng.random() < args.mapped_ratio]
+
+    def users():
+        yield (ROOT_USER_ID, args.root_login, 'John Doe', f'{args.root_login}@john-doe.xyz', hash(args.root_password), ROOT_ORGANIZATION_ID)
+        n = 0
+        for organization_id, *_ in itertools.chain(partners, customers):
+            for _ in range(args.users_per_org):
+                n += 1
+                yield (uuid(), f'user.{n}', f'User {n}', f'user.{n}@john-doe.xyz', None, organization_id)
+
+    db = sqlite_connect(filename)
+    db.execute('PRAGMA foreign_keys=OFF')
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute(f'PRAGMA cache_size=-{args.cache_mb * 1024}')
+    create_tables(db)
+
+    logging.info(f'Loading {len(partners)} partners and {len(customers)} customers...')
+    db.executemany('INSERT INTO organizations VALUES (?,?,?,?)', itertools.chain(partners, customers))
+    db.executemany('INSERT INTO organizations_mapping VALUES (?,?,?)', mappings)
+    logging.info(f'Loading {(len(partners) + len(customers)) * args.users_per_org + 1} users...')
+    db.executemany('INSERT INTO users VALUES (?,?,?,?,?,?)', users())
+    db.commit()
+
+    logging.info('Building indexes and the organizations closure...')
+    migrate(db)
+
+    db.execute('PRAGMA journal_mode=WAL')
+    db.close()
+
+
 def main(args):
     filename = join(dirname(realpath(__file__)), f'{args.db_name}.db')
 
+    if args.backfill:
+        backfill(filename)
+        return
+
     if exists(filename):
         logging.error(f'{filename} already exists. Either specify a new file name or move/delete the file.')
         return
 
     logging.info(f'Creating DB file {filename}...')
-    root_user = input('Enter root username: ').strip()
-    root_pwd = hash(getpass(f'Enter password for root user: ').strip())
+    if args.bulk:
+        generate(filename, args)
+        logging.info(f'Done.')
+        return
 
-    db = sqlite_connect(filename)
-    db.execute('CREATE TABLE IF NOT EXISTS users (id VARCHAR(36) NOT NULL PRIMARY KEY, login NVARCHAR(255) UNIQUE, name NVARCHAR(255), email VARCHAR(255), password VARCHAR(255), organization_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE) WITHOUT ROWID')
+    root_user = args.root_login or input('Enter root username: ').strip()
+    root_pwd = hash(args.root_password or getpass(f'Enter password for root user: ').strip())
 
-    db.execute('CREATE TABLE IF NOT EXISTS organizations (id VARCHAR(36) NOT NULL PRIMARY KEY, parent_id VARCHAR(36) REFERENCES organizations(id) ON DELETE CASCADE, name VARCHAR(255), kind TINYINT) WITHOUT ROWID')
-    db.execute('CREATE TABLE IF NOT EXISTS organizations_mapping (organization_id VARCHAR(36) PRIMARY KEY REFERENCES organizations(id) ON DELETE CASCADE, acronis_tenant_id VARCHAR(36) UNIQUE, acronis_dc_url VARCHAR(64)) WITHOUT ROWID')
-
-    db.execute('CREATE INDEX IF NOT EXISTS organization_parent_idx ON organizations(parent_id)')
+    db = sqlite_connect(filename)
+    create_tables(db)
+    migrate(db)
 
     db.execute('INSERT INTO organizations VALUES (?,?,?,?)', (ROOT_ORGANIZATION_ID, None, 'John Doe Inc.', OrganizationKind.PARTNER))
     for _ in range(5):
@@ -60,6 +149,20 @@ def main(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--db-name',  help='Database name', default='vendor')
+    parser.add_argument('--backfill', help='Apply the schema migrations to an existing database, the server and the connector also apply them on start', action='store_true')
+    parser.add_argument('--root-login', help='Root user\'s login, asked for if not specified')
+    parser.add_argument('--root-password', help='Root user\'s password, asked for if not specified')
+    parser.add_argument('--bulk', help='Generate a large synthetic dataset without prompts, requires --root-login and --root-password', action='store_true')
+    parser.add_argument('--depth', help='[bulk] Levels of sub-partners below the root partner', type=int, default=2)
+    parser.add_argument('--fan-out', help='[bulk] Sub-partners of every partner', type=int, default=10)
+    parser.add_argument('--customers', help='[bulk] Number of customers spread over all partners', type=int, default=10000)
+    parser.add_argument('--users-per-org', help='[bulk] Users in every organization', type=int, default=10)
+    parser.add_argument('--mapped-ratio', help='[bulk] Share of customers mapped to Acronis tenants', type=float, default=0.5)
+    parser.add_argument('--datacenter-url', help='[bulk] Datacenter URL of the mapped customers', default='https://eu8-cloud.acronis.com')
+    parser.add_argument('--seed', help='[bulk] Random seed, the same seed gives the same data', type=int, default=0)
+    parser.add_argument('--cache-mb', help='[bulk] SQLite page cache size while loading', type=int, default=512)
     args = parser.parse_args()
+    if args.bulk and not (args.root_login and args.root_password):
+        parser.error('--bulk requires --root-login and --root-password')
 
     main(args)
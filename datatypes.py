@@ -3,7 +3,8 @@
 # This source code is distributed under MIT software license.
 # ************************************************************
 
-from typing import TypedDict, Any
+import json
+from typing import TypedDict, Any, Optional
 from enum import IntEnum
 
 class OrganizationKind(IntEnum):
@@ -27,6 +28,29 @@ class CallbackResponse(TypedDict):
     response_id: str
     payload: dict[str, Any]
 
+class ResponseEnvelope:
+    """
+    A callback response type with its JSON envelope encoded in advance.
+
+    Rendering a response only encodes the request and response IDs and appends the already encoded payload,
+    instead of building a `CallbackResponse` dict and encoding it as a whole.
+    """
+
+    def __init__(self, type: str) -> None:
+        self.type = type
+        self._head = b'{"type":%s,"request_id":' % json.dumps(type).encode()
+
+
+    def payload_prefix(self, request_id: str, response_id: str) -> bytes:
+        """Everything up to the payload value, for writing the payload separately."""
+        return b'%s%s,"response_id":%s,"payload":' % (self._head, json.dumps(request_id).encode(), json.dumps(response_id).encode())
+
+
+    def render(self, request_id: str, response_id: str, payload: Optional[bytes] = None) -> bytes:
+        if payload is None:
+            return b'%s%s,"response_id":%s}' % (self._head, json.dumps(request_id).encode(), json.dumps(response_id).encode())
+        return b''.join((self.payload_prefix(request_id, response_id), payload, b'}'))
+
 class CallbackRequest(TypedDict):
     type: str
     request_id: str
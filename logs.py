@@ -0,0 +1,83 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sys
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every log record has, anything else was passed with `extra=` and goes into JSON records as is
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON lines with the fields passed in `extra=` kept as separate keys."""
+
+    def __init__(self, component: str) -> None:
+        super().__init__()
+        self.component = component
+
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'component': self.component,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Passes records to the writer thread as they are.
+
+    Unlike `QueueHandler`, the message is not formatted in the logging thread, so arguments are only turned into text
+    by the writer. When the queue is full the record is dropped instead of blocking the caller.
+    """
+
+    def __init__(self, queue: queue.Queue) -> None:
+        super().__init__(queue)
+        self.dropped = 0
+
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(component: str, format: str = 'text', level: int = logging.INFO, max_queue: int = 10000) -> QueueListener:
+    """
+    Sends the records of all loggers through a bounded queue to a background thread that writes them to stderr,
+    either as text or as JSON lines. The writer is stopped and the queue is flushed on exit.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    if format == 'json':
+        handler.setFormatter(JsonFormatter(component))
+    else:
+        handler.setFormatter(logging.Formatter(f'[{component}] %(asctime)s -- %(message)s'))
+
+    records = queue.Queue(max_queue)
+    root = logging.getLogger()
+    root.handlers = [BackgroundHandler(records)]
+    root.setLevel(level)
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
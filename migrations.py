@@ -0,0 +1,161 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sqlite3
+import logging
+from time import monotonic
+from typing import Callable, Optional
+
+from utils import sqlite_connect, create_organizations_closure, backfill_organizations_closure, create_change_log
+
+# Seconds to wait for another process that holds the write lock, such as one applying the same migrations
+LOCK_TIMEOUT = 600
+# Seconds between progress reports of a long migration step
+PROGRESS_INTERVAL = 5.0
+# SQLite instructions between checks whether it's time to report progress
+PROGRESS_STEPS = 1000000
+
+
+def _organizations_closure(conn: sqlite3.Connection) -> None:
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'organizations_closure'").fetchone()
+    create_organizations_closure(conn)
+    if not exists:
+        backfill_organizations_closure(conn)
+
+
+def _callback_responses(conn: sqlite3.Connection) -> None:
+    # Responses to write callbacks kept for their retries, see `server.idempotency.IdempotencyStore`
+    conn.execute('''CREATE TABLE IF NOT EXISTS callback_responses (
+        key VARCHAR(255) NOT NULL PRIMARY KEY,
+        expires_at REAL NOT NULL,
+        status INTEGER,
+        content_type VARCHAR(64),
+        body BLOB
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS callback_responses_expires_idx ON callback_responses(expires_at)')
+
+
+def _change_log_consumers_activity(conn: sqlite3.Connection) -> None:
+    # Existing consumers count as idle until they save their position again
+    conn.execute('ALTER TABLE change_log_consumers ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0')
+
+
+def _connector_outbox(conn: sqlite3.Connection) -> None:
+    # Requests of the connector waiting to be delivered and the ones that failed too many times, see
+    # `connector.outbox.Outbox`. Versions before migrations created these tables on start with a claimed flag.
+    conn.execute('''CREATE TABLE IF NOT EXISTS connector_outbox (
+        id INTEGER PRIMARY KEY,
+        endpoint VARCHAR(32) NOT NULL,
+        idempotency_key VARCHAR(36) NOT NULL UNIQUE,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        available_at REAL NOT NULL,
+        last_error TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS connector_outbox_due_idx ON connector_outbox(endpoint, available_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS connector_outbox_created_idx ON connector_outbox(endpoint, created_at)')
+    conn.execute('DROP INDEX IF EXISTS connector_outbox_claimed_idx')
+    conn.execute('''CREATE TABLE IF NOT EXISTS connector_outbox_dead (
+        id INTEGER PRIMARY KEY,
+        endpoint VARCHAR(32) NOT NULL,
+        idempotency_key VARCHAR(36) NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        failed_at REAL NOT NULL,
+        last_error TEXT
+    )''')
+
+
+def _index(name: str, table: str, columns: str, replaces: Optional[str] = None) -> Callable[[sqlite3.Connection], None]:
+    def create(conn: sqlite3.Connection) -> None:
+        rows = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        logging.info('Building index %s on %d rows of %s...', name, rows, table)
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})')
+        if replaces:
+            conn.execute(f'DROP INDEX IF EXISTS {replaces}')
+    return create
+
+
+# Applied in order, a migration's version is its position in the list starting from 1. Never change or reorder
+# migrations that were released, add new ones at the end.
+MIGRATIONS: list[tuple[str, Callable[[sqlite3.Connection], None]]] = [
+    ('Organizations closure', _organizations_closure),
+    ('Change log', create_change_log),
+    # Users read selects only these columns by organization, so it's answered from the index alone
+    ('Index users by organization', _index('users_organization_covering_idx', 'users', 'organization_id, id, name, email', replaces='users_organization_idx')),
+    ('Index organizations by parent and kind', _index('organizations_parent_kind_idx', 'organizations', 'parent_id, kind', replaces='organization_parent_idx')),
+    ('Index tenant mapping by datacenter', _index('organizations_mapping_datacenter_idx', 'organizations_mapping', 'acronis_dc_url, acronis_tenant_id')),
+    ('Callback responses', _callback_responses),
+    ('Change log consumers activity', _change_log_consumers_activity),
+    ('Connector outbox', _connector_outbox),
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+
+def _report_progress(name: str) -> Callable[[], int]:
+    start = last = monotonic()
+
+    def report() -> int:
+        nonlocal last
+        now = monotonic()
+        if now - last >= PROGRESS_INTERVAL:
+            last = now
+            logging.info('Migration %s is still running, %.0f seconds so far', name, now - start)
+        return 0
+    return report
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Applies the migrations newer than the version recorded in `schema_migrations` and returns the current version.
+
+    Every migration runs in its own transaction together with recording its version, so a failed one leaves the
+    schema at the previous version. The write lock is taken before checking the version, so processes that start
+    at the same time apply each migration once. With WAL, reads of other processes go on during a migration,
+    while their writes wait for it. Long migrations, such as building an index on a large table, report progress.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER NOT NULL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )''')
+    conn.commit()
+
+    version = schema_version(conn)
+    for number, (name, apply) in enumerate(MIGRATIONS[version:], version + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            logging.info('Applying migration %d: %s...', number, name)
+            start = monotonic()
+            conn.set_progress_handler(_report_progress(name), PROGRESS_STEPS)
+            try:
+                apply(conn)
+            finally:
+                conn.set_progress_handler(None, 0)
+            conn.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (number, name))
+            conn.commit()
+            logging.info('Applied migration %d in %.1f seconds', number, monotonic() - start)
+        except:
+            conn.rollback()
+            raise
+    return max(version, len(MIGRATIONS))
+
+
+def migrate_database(filename: str) -> int:
+    """Applies the migrations to the database file, waiting for other processes that are applying them."""
+    conn = sqlite_connect(filename, timeout=LOCK_TIMEOUT)
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
@@ -12,11 +12,12 @@ import argparse
 import json
 from os.path import join, dirname, realpath
 
-from connector import connector, ApiClient
-from utils import sqlite_connect
+from connector import connector, ApiClient, ConnectorSettings
+from server.database import Database
+from migrations import migrate_database
+from logs import setup_logging
 from dataclasses import dataclass
 
-logging.basicConfig(format='[Connector] %(asctime)s -- %(message)s', encoding='utf-8', level=logging.INFO)
 
 @dataclass
 class ConnectorConfig:
@@ -28,9 +29,17 @@ class ConnectorConfig:
 async def main(args, creds: ConnectorConfig):
     filename = join(dirname(realpath(__file__)), f'{args.db_name}.db')
 
-    db = sqlite_connect(filename)
+    migrate_database(filename)
+    db = Database(filename, readers=2)
     async with ApiClient(creds.dc_url, creds.client_id, creds.client_secret) as client:
-        await connector(db, client)
+        await connector(db, client, ConnectorSettings(
+            workers=args.workers,
+            alerts_rate=args.alerts_rate,
+            workloads_rate=args.workloads_rate,
+            batch_size=args.batch_size,
+            batch_delay=args.batch_delay,
+            delivery_attempts=args.delivery_attempts,
+        ))
     db.close()
 
 
@@ -41,9 +50,19 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config-path',  help='Path to config file', default='connector.json')
     parser.add_argument('--db-name',  help='Database name', default='vendor')
+    parser.add_argument('--workers',  help='Number of posts in flight at the same time per endpoint', type=int, default=16)
+    parser.add_argument('--alerts-rate',  help='Alert posts per second, 0 for no limit', type=float, default=10)
+    parser.add_argument('--workloads-rate',  help='Workload posts per second, 0 for no limit', type=float, default=10)
+    parser.add_argument('--batch-size',  help='Workloads posted in one request', type=int, default=100)
+    parser.add_argument('--batch-delay',  help='Seconds a workload may wait for its batch to fill up', type=float, default=1.0)
+    parser.add_argument('--delivery-attempts',  help='Attempts to post a queued request before it is moved to the dead letters', type=int, default=8)
+    parser.add_argument('--log-format',  help='Write logs as text or as JSON lines', choices=('text', 'json'), default='text')
+    parser.add_argument('--log-payloads',  help='Log alert and workload payloads', action='store_true')
 
     args = parser.parse_args()
 
+    setup_logging('Connector', args.log_format, logging.DEBUG if args.log_payloads else logging.INFO)
+
     with open(args.config_path) as f:
         creds = ConnectorConfig(**json.load(f))
 
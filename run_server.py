@@ -5,41 +5,98 @@
 # This source code is distributed under MIT software license.
 # ************************************************************
 
+import os
 import ssl
+import asyncio
 import logging
+import socket
 import argparse
 from os.path import join, dirname, realpath
+from typing import Optional
 from aiohttp import web
 
 import server.routes as routes
-from utils import sqlite_connect
-
-logging.basicConfig(format='[Service] %(asctime)s -- %(message)s', encoding='utf-8', level=logging.INFO)
+import server.codec as codec
+from server.auth import PasswordVerifier, CredentialCache
+from server.database import Database
+from server.query_log import QueryLog
+from server.response_cache import ResponseCache
+from server.idempotency import IdempotencyCache, IdempotencyStore
+from server.compression import Compression
+from server.admission import AdmissionControl
+from server.metrics import Metrics
+from server.changes import ChangeWatcher
+from server.workers import supervise
+from server.request_log import CallbackLogPolicy, Redacted
+from migrations import migrate_database
+from logs import setup_logging
 
 
 @web.middleware
 async def req_logger(request: web.Request, handler):
-    logging.info(f'Headers {request.headers}')
+    logging.info('Headers %s', Redacted(request.headers))
     return await handler(request)
 
 
-def main(args):
+async def prune_tables(app: web.Application):
+    tasks = [asyncio.create_task(app['changes'].prune()), asyncio.create_task(app['idempotency_store'].prune())]
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+def serve(args, worker: Optional[int] = None):
+    """Serves the application in this process. `worker` is the index of a worker process that shares the port with others."""
+    setup_logging('Service' if worker is None else f'Service-{worker}', args.log_format)
     filename = join(dirname(realpath(__file__)), f'{args.db_name}.db')
+    if worker is None:
+        migrate_database(filename)
 
-    db = sqlite_connect(filename)
+    codec.use(args.json_codec)
+    query_log = QueryLog(args.db_slow_query_ms / 1000, args.db_explain)
+    db = Database(filename, args.db_readers, query_log)
 
-    app = web.Application(middlewares=[req_logger])
+    app = web.Application(middlewares=[req_logger] if args.log_headers else [])
     app['db'] = db
+    app['verifier'] = PasswordVerifier(args.auth_workers, args.auth_executor)
+    app['credentials'] = CredentialCache(args.auth_cache_size, args.auth_cache_ttl, args.auth_cache_negative_ttl)
+    app['responses'] = ResponseCache(args.response_cache_mb * 1024 * 1024)
+    app['idempotency'] = IdempotencyCache(args.idempotency_cache_mb * 1024 * 1024, args.idempotency_ttl)
+    app['idempotency_store'] = IdempotencyStore(db, args.idempotency_ttl)
+    app['compression'] = Compression(args.compression_min_bytes, args.compression_level, args.compression_cache_mb * 1024 * 1024)
+    limits = {'read': (64, 256), 'write': (8, 256), 'auth': (args.auth_workers, args.auth_queue), **dict(args.admission_limit)}
+    app['admission'] = AdmissionControl(limits, args.admission_budget_ms / 1000)
+    app['changes'] = ChangeWatcher(filename, db, app['credentials'], app['responses'])
+    if not worker:
+        # A single server process, or the first of the workers, prunes the change log and the stored responses for all of them
+        app.cleanup_ctx.append(prune_tables)
+    app['metrics'] = Metrics()
+    app['request_log'] = CallbackLogPolicy(args.log_sample_rate, args.log_max_body, dict(args.log_callback))
     routes.setup(app)
 
+    reuse_port = worker is not None
     if args.certfile and args.keyfile:
         ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_ctx.load_cert_chain(args.certfile, args.keyfile)
-        web.run_app(app, port=443 if not args.port else args.port, ssl_context=ssl_ctx)
+        web.run_app(app, port=443 if not args.port else args.port, ssl_context=ssl_ctx, reuse_port=reuse_port)
     else:
-        web.run_app(app, port=8080 if not args.port else args.port)
+        web.run_app(app, port=8080 if not args.port else args.port, reuse_port=reuse_port)
 
+    app['changes'].close()
+    app['verifier'].close()
     db.close()
+    if args.db_explain:
+        for stats in query_log.report():
+            logging.info('Query stats %s', stats, extra=stats)
+
+
+def main(args):
+    if args.workers > 1:
+        setup_logging('Supervisor', args.log_format)
+        migrate_database(join(dirname(realpath(__file__)), f'{args.db_name}.db'))
+        supervise(serve, (args,), args.workers)
+    else:
+        serve(args)
 
 
 if __name__ == '__main__':
@@ -48,7 +105,33 @@ if __name__ == '__main__':
     parser.add_argument('--keyfile',  help='Path to certificate\'s private key.')
     parser.add_argument('--db-name',  help='Database name', default='vendor')
     parser.add_argument('--port',  help='Web server\'s port')
+    parser.add_argument('--workers', help='Number of server processes sharing the port, each with its own connections and caches', type=int, default=1)
+    parser.add_argument('--db-readers', help='Number of parallel database read connections', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--db-slow-query-ms', help='Log database statements that take longer than this with their query plan, 0 disables the log', type=float, default=100)
+    parser.add_argument('--db-explain', help='Development mode: log the statements that scan whole tables when they first run and the statistics of all statements on shutdown', action='store_true')
+    parser.add_argument('--auth-workers', help='Number of password verification workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--auth-executor', help='Run password verification in threads or processes', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--auth-queue', help='Number of verifications allowed to wait for a worker before rejecting with 503', type=int, default=64)
+    parser.add_argument('--auth-cache-size', help='Number of verified credentials to remember, 0 disables the cache', type=int, default=10000)
+    parser.add_argument('--auth-cache-ttl', help='Seconds to remember verified credentials', type=float, default=60)
+    parser.add_argument('--auth-cache-negative-ttl', help='Seconds to remember failed verifications', type=float, default=5)
+    parser.add_argument('--json-codec', help='JSON library for requests and responses, the fastest installed one by default', choices=tuple(codec.AVAILABLE), default=codec.codec.name)
+    parser.add_argument('--response-cache-mb', help='Memory budget of cached topology and tenant mapping responses in MB, 0 disables the cache', type=int, default=64)
+    parser.add_argument('--idempotency-cache-mb', help='Memory budget of responses kept for retried requests in MB, 0 disables keeping them in memory', type=int, default=16)
+    parser.add_argument('--idempotency-ttl', help='Seconds a response is kept for retried requests, 0 disables replaying them', type=float, default=300)
+    parser.add_argument('--compression-min-bytes', help='Compress response bodies of at least this size when the client accepts it', type=int, default=1024)
+    parser.add_argument('--compression-level', help='Compression level, higher levels take more CPU for smaller responses, 0 disables compression', type=int, default=1)
+    parser.add_argument('--compression-cache-mb', help='Memory budget of compressed topology and tenant mapping payloads in MB, 0 disables the cache', type=int, default=16)
+    parser.add_argument('--admission-limit', help='Running and waiting requests of a callback class as <read|write|auth>=<running>[,<waiting>], can be repeated. Defaults are read=64,256, write=8,256 and auth=<auth-workers>,<auth-queue>', type=AdmissionControl.parse_limit, action='append', default=[])
+    parser.add_argument('--admission-budget-ms', help='Longest wait for a callback to be admitted, callbacks expected to wait longer are rejected with 503 right away', type=float, default=1000)
+    parser.add_argument('--log-format', help='Write logs as text or as JSON lines', choices=('text', 'json'), default='text')
+    parser.add_argument('--log-headers', help='Log request headers, credentials are redacted', action='store_true')
+    parser.add_argument('--log-sample-rate', help='Share of callback requests whose bodies are logged', type=float, default=1.0)
+    parser.add_argument('--log-max-body', help='Number of logged bytes of request and response bodies', type=int, default=2048)
+    parser.add_argument('--log-callback', help='Sample rate and body size for a single callback as <callback_id>=<rate>[,<max_body>], can be repeated', type=CallbackLogPolicy.parse_override, action='append', default=[])
 
     args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers requires SO_REUSEPORT, which is not supported on this platform')
 
     main(args)
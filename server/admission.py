@@ -0,0 +1,142 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import math
+import asyncio
+from time import monotonic
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+# Weight of the latest duration in the moving average of the time a request holds a slot
+SERVICE_TIME_WEIGHT = 0.1
+CLASSES = ('read', 'write', 'auth')
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class Limiter:
+    """
+    Lets at most `max_in_flight` requests of a class run at the same time, at most `max_queue` more wait for a slot in
+    arrival order.
+
+    A request is rejected with `Overloaded` when the queue is full, when the expected wait is longer than `budget`
+    seconds, or when it has waited for `budget` seconds. The expected wait is the number of requests ahead of it times
+    the average time a request holds a slot, divided by the number of slots.
+    """
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int, budget: float) -> None:
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.budget = budget
+        self.in_flight = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.service_time = 0.0
+        self.admitted = 0
+        self.shed = {'queue_full': 0, 'budget': 0}
+
+
+    def expected_wait(self) -> float:
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return (len(self.waiters) + 1) * self.service_time / self.max_in_flight
+
+
+    def check(self) -> None:
+        """Rejects a request that would be rejected on `acquire` right away, so it's rejected before doing any work."""
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.shed['queue_full'] += 1
+            raise Overloaded(f'Too many pending {self.name} requests', self.expected_wait())
+        wait = self.expected_wait()
+        if wait > self.budget:
+            self.shed['budget'] += 1
+            raise Overloaded(f'Expected wait for a slot of the {self.name} class is {wait:.3f}s', wait)
+
+
+    async def acquire(self) -> None:
+        self.check()
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait((waiter,), timeout=self.budget)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+                waiter.cancel()
+            raise
+        if not waiter.done():
+            self.waiters.remove(waiter)
+            waiter.cancel()
+            self.shed['budget'] += 1
+            raise Overloaded(f'Waited {self.budget:.3f}s for a slot of the {self.name} class', self.expected_wait())
+        self.admitted += 1
+
+
+    def release(self) -> None:
+        # The slot is handed over to the first waiter, so a new request can't take it first
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.service_time += (monotonic() - start - self.service_time) * SERVICE_TIME_WEIGHT
+            self.release()
+
+
+class AdmissionControl:
+    """
+    Limiters of the callback classes: `read` and `write` callbacks are limited while they run, `auth` limits password
+    verifications of credentials that are not in the `CredentialCache`.
+
+    Limits are `(max_in_flight, max_queue)` by class, `budget` is the longest wait for a slot in seconds.
+    """
+
+    def __init__(self, limits: dict[str, tuple[int, int]], budget: float) -> None:
+        self.limiters = {name: Limiter(name, *limits[name], budget) for name in CLASSES}
+
+
+    def __getitem__(self, name: str) -> Limiter:
+        return self.limiters[name]
+
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[str, tuple[int, int]]:
+        """Parses `<class>=<max_in_flight>[,<max_queue>]`."""
+        name, _, settings = value.partition('=')
+        if name not in CLASSES:
+            raise ValueError(f'Unknown callback class {name}')
+        max_in_flight, _, max_queue = settings.partition(',')
+        if int(max_in_flight) < 1:
+            raise ValueError('At least one request of a class must be allowed to run')
+        return name, (int(max_in_flight), int(max_queue or 0))
@@ -0,0 +1,100 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import os
+import hmac
+import asyncio
+from time import monotonic
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional
+
+from utils import verify
+
+
+class PasswordVerifier:
+    """
+    Runs Argon2 verification in a pool of `workers` threads or processes so that the event loop keeps serving requests.
+
+    The number of verifications running and waiting is limited by the `auth` class of `server.admission`.
+    """
+
+    def __init__(self, workers: int, executor: str = 'thread') -> None:
+        self.workers = workers
+        self.executor: Executor = ProcessPoolExecutor(workers) if executor == 'process' else ThreadPoolExecutor(workers, thread_name_prefix='argon2')
+
+
+    async def verify(self, hash: str, password: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, verify, hash, password)
+
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class CredentialCache:
+    """
+    Remembers the outcome of credential verification so that repeated callbacks skip the users lookup and Argon2.
+
+    Entries are keyed by an HMAC of identity and secret with a per-process key, so neither is kept in memory in clear.
+    Successful lookups are kept for `ttl` seconds, failed ones for `negative_ttl` seconds. A changed password never
+    matches an entry made for the old one. Entries of a changed or removed user are dropped with `invalidate_user`.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60, negative_ttl: float = 5) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries: OrderedDict[bytes, tuple[float, Optional[dict]]] = OrderedDict()
+        self.user_keys: dict[str, set[bytes]] = {}
+        self._key = os.urandom(32)
+
+
+    def key(self, identity: str, secret: str) -> bytes:
+        return hmac.new(self._key, f'{identity.lower()}\0{secret}'.encode(), sha256).digest()
+
+
+    def get(self, key: bytes) -> tuple[bool, Optional[dict]]:
+        """Returns `(found, user)`, where `user` is `None` for a cached failure."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] < monotonic():
+            self._remove(key)
+            return False, None
+        self.entries.move_to_end(key)
+        return True, entry[1]
+
+
+    def put(self, key: bytes, user: Optional[dict]) -> None:
+        if self.max_size <= 0:
+            return
+        self._remove(key)
+        self.entries[key] = (monotonic() + (self.ttl if user else self.negative_ttl), user)
+        if user:
+            self.user_keys.setdefault(user['id'], set()).add(key)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+
+    def invalidate_user(self, user_id: str) -> None:
+        for key in self.user_keys.pop(user_id, ()):
+            self.entries.pop(key, None)
+
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.user_keys.clear()
+
+
+    def _remove(self, key: bytes) -> None:
+        entry = self.entries.pop(key, None)
+        if entry and entry[1]:
+            keys = self.user_keys.get(entry[1]['id'])
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.user_keys[entry[1]['id']]
@@ -5,8 +5,55 @@
 
 import server.callbacks.enablement as enablement
 import server.callbacks.user_management as user_management
+from server.schemas import compile_schema
 
 CALLBACKS_MAPPING = {
     **enablement.mapping,
     **user_management.mapping,
 }
+
+# The parts of the request envelope the handler and the callbacks rely on
+REQUEST_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'request_id': {'type': 'string'},
+        'context': {
+            'type': 'object',
+            'properties': {
+                'callback_id': {'type': 'string'},
+                'tenant_id': {'type': 'string'},
+                'datacenter_url': {'type': 'string'},
+            },
+            'required': ['callback_id', 'tenant_id', 'datacenter_url'],
+        },
+    },
+    'required': ['request_id', 'context'],
+}
+validate_request = compile_schema(REQUEST_SCHEMA, 'request')
+
+# Payload validators of the callbacks that take a payload, compiled once on import
+PAYLOAD_VALIDATORS = {
+    callback_id: compile_schema(schema)
+    for callback_id, schema in {**enablement.schemas, **user_management.schemas}.items()
+}
+
+# Callbacks that change the user with `payload['id']`, cached credentials of this user are dropped after them
+CREDENTIALS_INVALIDATING_CALLBACKS = {
+    *user_management.invalidates_credentials,
+}
+
+# Read callbacks with cacheable payloads: callback ID -> (response envelope, payload reader)
+CACHED_CALLBACKS = {
+    **enablement.cached,
+}
+
+# Callbacks after which all cached payloads are dropped
+RESPONSES_INVALIDATING_CALLBACKS = {
+    *enablement.invalidates_responses,
+}
+
+# Callbacks that write to the database, the rest only read from it
+WRITE_CALLBACKS = {
+    *enablement.writes,
+    *user_management.writes,
+}
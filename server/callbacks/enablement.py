@@ -7,37 +7,28 @@ import sqlite3
 from typing import Optional
 from datatypes import *
 from aiohttp import web
+from server.database import Database
+import server.codec as codec
+
+SUCCESS_NO_CONTENT = ResponseEnvelope('cti.a.p.acgw.response.v1.0~a.p.success_no_content.v1.0')
+ENABLEMENT_READ_OK = ResponseEnvelope('cti.a.p.acgw.response.v1.0~a.p.enablement.read.ok.v1.0')
+TOPOLOGY_READ_OK = ResponseEnvelope('cti.a.p.acgw.response.v1.0~a.p.topology.read.ok.v1.0')
+TENANT_MAPPING_READ_OK = ResponseEnvelope('cti.a.p.acgw.response.v1.0~a.p.tenant_mapping.read.ok.v1.0')
 
 
 def callback_enablement_reset(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
-    conn.execute('DELETE FROM organizations_mapping WHERE organization_id IN (SELECT id FROM organizations WHERE parent_id = ?) OR organization_id = ?', (organization_id, organization_id)).fetchone()
-    conn.commit()
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.success_no_content.v1.0',
-            request_id=request_id,
-            response_id=response_id,
-        )
-    )
+    conn.execute('DELETE FROM organizations_mapping WHERE organization_id IN (SELECT id FROM organizations WHERE parent_id = ?) OR organization_id = ?', (organization_id, organization_id))
+    return codec.callback_response(SUCCESS_NO_CONTENT, request_id, response_id)
 
 
-def callback_enablement_read(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+async def callback_enablement_read(db: Database, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
     payload: OrganizationMappingPair = { 'vendor_tenant_id': organization_id }
 
-    row = conn.execute('SELECT acronis_tenant_id FROM organizations_mapping WHERE organization_id = ?', (organization_id,)).fetchone()
+    row = await db.fetchone('SELECT acronis_tenant_id FROM organizations_mapping WHERE organization_id = ?', (organization_id,))
     if row:
         payload['acronis_tenant_id'] = row['acronis_tenant_id']
 
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.enablement.read.ok.v1.0',
-            request_id=request_id,
-            response_id=response_id,
-            payload=payload
-        )
-    )
+    return codec.callback_response(ENABLEMENT_READ_OK, request_id, response_id, payload)
 
 
 def callback_enablement_write(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
@@ -46,127 +37,108 @@ def callback_enablement_write(conn: sqlite3.Connection, organization_id: str, re
     if not data:
         data = { 'organization_id': organization_id }
         conn.execute('INSERT OR IGNORE INTO organizations_mapping VALUES (?,?,?)', (organization_id, payload['acronis_tenant_id'], context['datacenter_url']))
-        conn.commit()
+
     # In case there was a mapping to acronis tenant - check if already mapped organization ID matches the credentials
     if data['organization_id'] != organization_id:
-        return web.json_response(status=403, data={'response_id': response_id, 'message': 'You\'re not allowed to re-map this organization to different Acronis tenant ID.'})
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.success_no_content.v1.0',
-            request_id=request_id,
-            response_id=response_id
-        )
-    )
+        return codec.json_response({'response_id': response_id, 'message': 'You\'re not allowed to re-map this organization to different Acronis tenant ID.'}, status=403)
+    return codec.callback_response(SUCCESS_NO_CONTENT, request_id, response_id)
 
 
-def callback_topology_read(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+async def read_topology(db: Database, organization_id: str, context: CallbackContext) -> dict:
     items: list[TopologyInfo] = [
         { 'id': row['id'], 'name': row['name'] }
-        for row in conn.execute(
-            '''WITH RECURSIVE organizations_tree AS (
-                SELECT id, name, kind, parent_id AS direct_parent_id, parent_id FROM organizations
-
-                UNION ALL
-
-                SELECT p.id, p.name, p.kind, p.parent_id AS direct_parent_id, (SELECT parent_id FROM organizations WHERE id = p.parent_id) AS parent
-                FROM organizations_tree AS p
-                WHERE parent IS NOT NULL
-            )
-            SELECT id, name FROM organizations_tree WHERE parent_id = ? AND kind = ?''', 
+        for row in await db.fetchall(
+            '''SELECT orgs.id, orgs.name
+            FROM organizations_closure AS tree
+            JOIN organizations AS orgs ON orgs.id = tree.descendant_id
+            WHERE tree.ancestor_id = ? AND tree.depth > 0 AND orgs.kind = ?''',
             (organization_id, OrganizationKind.CUSTOMER)
-        ).fetchall()
-    ]
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.topology.read.ok.v1.0',
-            request_id=request_id,
-            response_id=response_id,
-            payload={ 'items': items }
         )
-    )
+    ]
+    return { 'items': items }
+
+
+async def callback_topology_read(db: Database, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+    return codec.callback_response(TOPOLOGY_READ_OK, request_id, response_id, await read_topology(db, organization_id, context))
 
 
-def callback_tenant_mapping_read(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+async def read_tenant_mapping(db: Database, organization_id: str, context: CallbackContext) -> dict:
     items: list[OrganizationMappingPair] = [
         dict(row)
-        for row in conn.execute(
-            '''WITH RECURSIVE organizations_tree AS (
-                SELECT id, name, kind, parent_id AS direct_parent_id, parent_id FROM organizations
-
-                UNION ALL
-
-                SELECT p.id, p.name, p.kind, p.parent_id AS direct_parent_id, (SELECT parent_id FROM organizations WHERE id = p.parent_id) AS parent
-                FROM organizations_tree AS p
-                WHERE parent IS NOT NULL
-            )
-            SELECT orgs.id AS vendor_tenant_id, map.acronis_tenant_id 
-            FROM organizations_tree AS orgs 
-            JOIN organizations_mapping AS map ON orgs.id = map.organization_id 
-            WHERE (map.acronis_dc_url IS NULL OR map.acronis_dc_url = ?) AND orgs.parent_id = ? AND orgs.kind = ?''',
+        for row in await db.fetchall(
+            '''SELECT orgs.id AS vendor_tenant_id, map.acronis_tenant_id
+            FROM organizations_closure AS tree
+            JOIN organizations AS orgs ON orgs.id = tree.descendant_id
+            JOIN organizations_mapping AS map ON orgs.id = map.organization_id
+            WHERE (map.acronis_dc_url IS NULL OR map.acronis_dc_url = ?) AND tree.ancestor_id = ? AND tree.depth > 0 AND orgs.kind = ?''',
             (context['datacenter_url'], organization_id, OrganizationKind.CUSTOMER)
-        ).fetchall()
-    ]
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.tenant_mapping.read.ok.v1.0',
-            request_id=request_id,
-            response_id=response_id,
-            payload={ 'items': items }
         )
-    )
+    ]
+    return { 'items': items }
 
 
-def callback_tenant_mapping_write(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
-    orgs: list[str] = [
-        row['id'] for row in conn.execute(
-            '''WITH RECURSIVE organizations_tree AS (
-                SELECT id, name, kind, parent_id AS direct_parent_id, parent_id FROM organizations
-
-                UNION ALL
-
-                SELECT p.id, p.name, p.kind, p.parent_id AS direct_parent_id, (SELECT parent_id FROM organizations WHERE id = p.parent_id) AS parent
-                FROM organizations_tree AS p
-                WHERE parent IS NOT NULL
-            )
-            SELECT id FROM organizations_tree WHERE parent_id = ? AND kind = ?''',
-            (organization_id, OrganizationKind.CUSTOMER)
-        ).fetchall()
-    ]
+async def callback_tenant_mapping_read(db: Database, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+    return codec.callback_response(TENANT_MAPPING_READ_OK, request_id, response_id, await read_tenant_mapping(db, organization_id, context))
+
+
+def write_tenant_mapping(conn: sqlite3.Connection, organization_id: str, datacenter_url: str, modified: list[OrganizationMappingPair]) -> Optional[str]:
+    """
+    Applies the modified mapping with a few set-based statements, returns an error message if nothing was written.
+
+    The items are loaded into a temporary table, so ownership is checked with one join and the mapping is changed
+    with two deletes and one upsert regardless of the number of items.
+    """
     # There's nothing to map if there're no orgs
-    if not orgs:
-        return web.json_response(status=400, data={'response_id': response_id, 'message': 'Nothing to map'})
-    to_insert: list[OrganizationMappingPair] = []
-
-    def conformant_map(modified: list[OrganizationMappingPair]) -> bool:
-        for item in modified:
-            # Don't allow to overwrite your own mapping and don't allow to write mapping to an org you don't have
-            if item['vendor_tenant_id'] not in orgs:
-                return False
-            if 'acronis_tenant_id' not in item or not item['acronis_tenant_id']:
-                conn.execute('DELETE FROM organizations_mapping WHERE organization_id = ?', (item['vendor_tenant_id'],))
-                continue
-            conn.execute('DELETE FROM organizations_mapping WHERE acronis_tenant_id = ?', (item['acronis_tenant_id'],))
-            to_insert.append({'vendor_tenant_id': item['vendor_tenant_id'], 'acronis_tenant_id': item['acronis_tenant_id'], 'acronis_dc_url': context['datacenter_url']})
-        conn.executemany('INSERT INTO organizations_mapping VALUES (:vendor_tenant_id, :acronis_tenant_id, :acronis_dc_url) ON CONFLICT(acronis_tenant_id) DO UPDATE SET organization_id = :vendor_tenant_id WHERE acronis_tenant_id = :acronis_tenant_id', to_insert)
-        return True
-
-    res = conformant_map(payload['modified'])
-    if not res:
+    has_orgs = conn.execute(
+        '''SELECT 1
+        FROM organizations_closure AS tree
+        JOIN organizations AS orgs ON orgs.id = tree.descendant_id
+        WHERE tree.ancestor_id = ? AND tree.depth > 0 AND orgs.kind = ?
+        LIMIT 1''',
+        (organization_id, OrganizationKind.CUSTOMER)
+    ).fetchone()
+    if not has_orgs:
+        return 'Nothing to map'
+
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS tenant_mapping_modified (seq INTEGER PRIMARY KEY, vendor_tenant_id VARCHAR(36), acronis_tenant_id VARCHAR(36))')
+    conn.execute('DELETE FROM temp.tenant_mapping_modified')
+    conn.executemany(
+        'INSERT INTO temp.tenant_mapping_modified VALUES (?,?,?)',
+        ((seq, item['vendor_tenant_id'], item.get('acronis_tenant_id') or None) for seq, item in enumerate(modified))
+    )
+
+    # Don't allow to overwrite your own mapping and don't allow to write mapping to an org you don't have
+    not_owned = conn.execute(
+        '''SELECT 1
+        FROM temp.tenant_mapping_modified AS item
+        LEFT JOIN organizations_closure AS tree ON tree.ancestor_id = ? AND tree.descendant_id = item.vendor_tenant_id AND tree.depth > 0
+        LEFT JOIN organizations AS orgs ON orgs.id = tree.descendant_id AND orgs.kind = ?
+        WHERE orgs.id IS NULL
+        LIMIT 1''',
+        (organization_id, OrganizationKind.CUSTOMER)
+    ).fetchone()
+    if not_owned:
         conn.rollback()
-        return web.json_response(status=400, data={'response_id': response_id, 'message': 'Failed to write the mapping.'})
-
-    conn.commit()
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type='cti.a.p.acgw.response.v1.0~a.p.success_no_content.v1.0',
-            request_id=request_id,
-            response_id=response_id
-        )
+        return 'Failed to write the mapping.'
+
+    conn.execute('DELETE FROM organizations_mapping WHERE organization_id IN (SELECT vendor_tenant_id FROM temp.tenant_mapping_modified WHERE acronis_tenant_id IS NULL)')
+    conn.execute('DELETE FROM organizations_mapping WHERE acronis_tenant_id IN (SELECT acronis_tenant_id FROM temp.tenant_mapping_modified WHERE acronis_tenant_id IS NOT NULL)')
+    # Items are applied in their order, so the last one wins when several items map the same Acronis tenant
+    conn.execute(
+        '''INSERT INTO organizations_mapping (organization_id, acronis_tenant_id, acronis_dc_url)
+        SELECT vendor_tenant_id, acronis_tenant_id, ? FROM temp.tenant_mapping_modified WHERE acronis_tenant_id IS NOT NULL ORDER BY seq
+        ON CONFLICT(acronis_tenant_id) DO UPDATE SET organization_id = excluded.organization_id''',
+        (datacenter_url,)
     )
+    return None
+
+
+def callback_tenant_mapping_write(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+    error = write_tenant_mapping(conn, organization_id, context['datacenter_url'], payload['modified'])
+    if error:
+        return codec.json_response({'response_id': response_id, 'message': error}, status=400)
+
+    return codec.callback_response(SUCCESS_NO_CONTENT, request_id, response_id)
 
 
 # mandatory callbacks
@@ -178,3 +150,48 @@ mapping = {
     'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.read.v1.0': callback_tenant_mapping_read,
     'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.write.v1.0': callback_tenant_mapping_write
 }
+
+# read callbacks whose payload depends only on the organization and the datacenter, the handler caches their payloads
+cached = {
+    'cti.a.p.acgw.callback.v1.0~a.p.topology.read.v1.0': (TOPOLOGY_READ_OK, read_topology),
+    'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.read.v1.0': (TENANT_MAPPING_READ_OK, read_tenant_mapping),
+}
+
+# callbacks that change the organizations mapping
+invalidates_responses = {
+    'cti.a.p.acgw.callback.v1.0~a.p.enablement.write.v1.0',
+    'cti.a.p.acgw.callback.v1.0~a.p.enablement.reset.v1.0',
+    'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.write.v1.0',
+}
+
+# callbacks that write to the database, the mapping is all they change. They run on the writer connection in the
+# transaction of the request.
+writes = invalidates_responses
+
+# request payload schemas, the handler rejects payloads that don't match them before authentication
+schemas = {
+    'cti.a.p.acgw.callback.v1.0~a.p.enablement.write.v1.0': {
+        'type': 'object',
+        'properties': {
+            'acronis_tenant_id': {'type': 'string'},
+        },
+        'required': ['acronis_tenant_id'],
+    },
+    'cti.a.p.acgw.callback.v1.0~a.p.tenant_mapping.write.v1.0': {
+        'type': 'object',
+        'properties': {
+            'modified': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'vendor_tenant_id': {'type': 'string'},
+                        'acronis_tenant_id': {'type': ['string', 'null']},
+                    },
+                    'required': ['vendor_tenant_id'],
+                },
+            },
+        },
+        'required': ['modified'],
+    },
+}
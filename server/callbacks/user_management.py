@@ -4,124 +4,157 @@
 # ************************************************************
 
 import sqlite3
-from typing import Optional
+from bisect import bisect_left
+from time import perf_counter
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from typing import AsyncIterator, Optional
 from uuid import uuid4
 from datatypes import *
 from aiohttp import web
 from constants import APPCODE
+from server.database import Database
+from server.metrics import add_time
+import server.codec as codec
+
+USER_WRITE_SUCCESS = ResponseEnvelope(f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_write_success.v1.0')
+USER_UPDATE_SUCCESS = ResponseEnvelope(f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_update_success.v1.0')
+USER_DELETE_SUCCESS = ResponseEnvelope(f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_delete_success.v1.0')
+USERS_READ_SUCCESS = ResponseEnvelope(f'cti.a.p.acgw.response.v1.0~{APPCODE}.users_read_success.v1.0')
 
 def callback_user_write(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: dict) -> web.Response:
     data = conn.execute('SELECT organization_id FROM organizations_mapping WHERE acronis_tenant_id = ?', (context['tenant_id'],)).fetchone()
     if not data:
-        return web.json_response(
-            status=200,
-            data=CallbackResponse(
-                type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_write_success.v1.0',
-                request_id=request_id,
-                response_id=response_id
-            )
-        )
+        return codec.callback_response(USER_WRITE_SUCCESS, request_id, response_id)
 
     conn.execute('INSERT INTO users VALUES (?,?,?,?,?,?)', (str(uuid4()), payload['login'], payload['name'], payload['email'], None, data['organization_id']))
-    conn.commit()
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_write_success.v1.0',
-            request_id=request_id,
-            response_id=response_id
-        )
-    )
+    return codec.callback_response(USER_WRITE_SUCCESS, request_id, response_id)
 
 def callback_user_update(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: dict) -> web.Response:
     data = conn.execute('SELECT organization_id FROM organizations_mapping WHERE acronis_tenant_id = ?', (context['tenant_id'],)).fetchone()
     if not data:
-        return web.json_response(
-            status=200,
-            data=CallbackResponse(
-                type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_update_success.v1.0',
-                request_id=request_id,
-                response_id=response_id
-            )
-        )
+        return codec.callback_response(USER_UPDATE_SUCCESS, request_id, response_id)
 
     conn.execute(f'UPDATE users SET name = ?, email = ? WHERE id = ? AND organization_id = ?', (payload['name'], payload['email'], payload['id'], data['organization_id']))
-    conn.commit()
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_update_success.v1.0',
-            request_id=request_id,
-            response_id=response_id
-        )
-    )
+    return codec.callback_response(USER_UPDATE_SUCCESS, request_id, response_id)
 
 def callback_user_delete(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: dict) -> web.Response:
     data = conn.execute('SELECT organization_id FROM organizations_mapping WHERE acronis_tenant_id = ?', (context['tenant_id'],)).fetchone()
     if not data:
-        return web.json_response(
-            status=200,
-            data=CallbackResponse(
-                type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_delete_success.v1.0',
-                request_id=request_id,
-                response_id=response_id
-            )
-        )
+        return codec.callback_response(USER_DELETE_SUCCESS, request_id, response_id)
 
     conn.execute('DELETE FROM users WHERE id = ? AND organization_id = ?', (payload['id'], data['organization_id']))
-    conn.commit()
-    return web.json_response(
-        status=200,
-        data=CallbackResponse(
-            type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.user_delete_success.v1.0',
-            request_id=request_id,
-            response_id=response_id
-        )
-    )
+    return codec.callback_response(USER_DELETE_SUCCESS, request_id, response_id)
 
-def callback_users_read(conn: sqlite3.Connection, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
-    data = conn.execute('SELECT organization_id FROM organizations_mapping WHERE acronis_tenant_id = ?', (context['tenant_id'],)).fetchone()
+async def callback_users_read(db: Database, organization_id: str, request_id: str, response_id: str, context: CallbackContext, payload: Optional[dict]) -> web.Response:
+    data = await db.fetchone('SELECT organization_id FROM organizations_mapping WHERE acronis_tenant_id = ?', (context['tenant_id'],))
     if not data:
-        return web.json_response(
-            status=200,
-            data=CallbackResponse(
-                type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.users_read_success.v1.0',
-                request_id=request_id,
-                response_id=response_id,
-                payload={ 'items': [] }
-            )
-        )
-
-    data: list[UserData] = [
-        dict(row)
-        for row in conn.execute(
-            '''WITH RECURSIVE organizations_tree AS (
-                SELECT id, name, kind, parent_id AS direct_parent_id, parent_id FROM organizations
-
-                UNION ALL
-
-                SELECT p.id, p.name, p.kind, p.parent_id AS direct_parent_id, (SELECT parent_id FROM organizations WHERE id = p.parent_id) AS parent
-                FROM organizations_tree AS p
-                WHERE parent IS NOT NULL
-            )
-
-            SELECT id, name, email FROM users 
-            WHERE organization_id IN (
-                SELECT orgs.id FROM organizations_tree AS orgs 
-                JOIN organizations_mapping AS map 
-                ON orgs.id = map.organization_id WHERE orgs.parent_id = ?
-            ) OR organization_id = ?''', (data['organization_id'], data['organization_id'])
-        ).fetchall()
-    ]
-    return web.json_response(
+        return codec.callback_response(USERS_READ_SUCCESS, request_id, response_id, { 'items': [] })
+
+    try:
+        after = _decode_cursor(payload['after']) if payload and payload.get('after') else ('', '')
+        limit = int(payload['limit']) if payload and 'limit' in payload else None
+    except (ValueError, TypeError):
+        return codec.json_response({'response_id': response_id, 'message': 'Invalid pagination parameters.'}, status=400)
+    if limit is not None and limit < 1:
+        return codec.json_response({'response_id': response_id, 'message': 'Invalid pagination parameters.'}, status=400)
+
+    # The organizations and the first page are read before responding so that database errors still produce a proper error response
+    organization_ids = await _read_user_organizations(db, data['organization_id'])
+    first_page = await db.read(_read_users_page, organization_ids, after, limit)
+    return web.Response(
         status=200,
-        data=CallbackResponse(
-            type=f'cti.a.p.acgw.response.v1.0~{APPCODE}.users_read_success.v1.0',
-            request_id=request_id,
-            response_id=response_id,
-            payload={ 'items': data }
-        )
+        body=_stream_users(db, organization_ids, request_id, response_id, limit, first_page),
+        content_type='application/json'
+    )
+
+
+USERS_PAGE_SIZE = 1000
+# Organizations bound to one page query, a page is filled with as many queries as needed
+USERS_PAGE_ORGANIZATIONS = 500
+
+
+def _encode_cursor(row) -> str:
+    return urlsafe_b64encode(codec.dumps([row['organization_id'], row['id']])).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[str, str]:
+    value = codec.loads(urlsafe_b64decode(cursor.encode()))
+    if not (isinstance(value, list) and len(value) == 2 and all(isinstance(v, str) for v in value)):
+        raise ValueError('Invalid cursor')
+    return value[0], value[1]
+
+
+async def _read_user_organizations(db: Database, organization_id: str) -> list[str]:
+    """Returns the organization and its mapped descendants in ascending order."""
+    rows = await db.fetchall(
+        '''SELECT map.organization_id FROM organizations_closure AS tree
+        JOIN organizations_mapping AS map
+        ON tree.descendant_id = map.organization_id WHERE tree.ancestor_id = ? AND tree.depth > 0
+        UNION
+        SELECT ?
+        ORDER BY 1''', (organization_id, organization_id)
     )
+    return [row[0] for row in rows]
+
+
+# The rest of the cursor's organization, a seek on (organization_id, id) in the covering index
+USERS_OF_ORGANIZATION = '''SELECT id, name, email, organization_id FROM users
+    WHERE organization_id = ? AND id > ?
+    ORDER BY id
+    LIMIT ?'''
+
+
+def _users_of_organizations(count: int) -> str:
+    """Users of whole organizations, ordered by (organization_id, id)."""
+    return f'''SELECT id, name, email, organization_id FROM users
+    WHERE organization_id IN ({','.join('?' * count)})
+    ORDER BY organization_id, id
+    LIMIT ?'''
+
+
+def _read_users_page(conn: sqlite3.Connection, organization_ids: list[str], after: tuple[str, str], limit: Optional[int]) -> tuple[list, bool]:
+    """
+    Reads up to a page of users ordered by (organization_id, id) after the cursor, returns the rows and whether there are more.
+
+    The cursor's organization is read from the cursor's user on and the following organizations from their first user,
+    so no page reads the users before the cursor.
+    """
+    size = min(USERS_PAGE_SIZE, limit) if limit else USERS_PAGE_SIZE
+    rows = []
+    start = bisect_left(organization_ids, after[0])
+    if start < len(organization_ids) and organization_ids[start] == after[0]:
+        rows += conn.execute(USERS_OF_ORGANIZATION, (after[0], after[1], size + 1)).fetchall()
+        start += 1
+    for start in range(start, len(organization_ids), USERS_PAGE_ORGANIZATIONS):
+        if len(rows) > size:
+            break
+        chunk = organization_ids[start:start + USERS_PAGE_ORGANIZATIONS]
+        rows += conn.execute(_users_of_organizations(len(chunk)), (*chunk, size + 1 - len(rows))).fetchall()
+    return rows[:size], len(rows) > size
+
+
+async def _stream_users(db: Database, organization_ids: list[str], request_id: str, response_id: str, limit: Optional[int], page: tuple[list, bool]) -> AsyncIterator[bytes]:
+    """Encodes the users page by page, so that neither the rows nor the response body are held in memory at once."""
+    yield USERS_READ_SUCCESS.payload_prefix(request_id, response_id) + b'{"items":['
+
+    rows, more = page
+    sent = 0
+    while rows:
+        start = perf_counter()
+        items: list[UserData] = [{ 'id': row['id'], 'name': row['name'], 'email': row['email'] } for row in rows]
+        chunk = (b',' if sent else b'') + codec.dumps(items)[1:-1]
+        add_time('serialize', perf_counter() - start)
+        yield chunk
+        sent += len(rows)
+        last = rows[-1]
+        if not more or (limit and sent >= limit):
+            break
+        rows, more = await db.read(_read_users_page, organization_ids, (last['organization_id'], last['id']), limit - sent if limit else None)
+
+    if limit and more:
+        yield b'],"next":%s}}' % codec.dumps(_encode_cursor(last))
+    else:
+        yield b']}}'
 
 
 # custom callbacks
@@ -131,3 +164,51 @@ mapping = {
     f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_update.v1.0': callback_user_update,
     f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_delete.v1.0': callback_user_delete,
 }
+
+# callbacks that change a user row
+invalidates_credentials = {
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_update.v1.0',
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_delete.v1.0',
+}
+
+# callbacks that write to the database, they run on the writer connection in the transaction of the request
+writes = {
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_write.v1.0',
+    *invalidates_credentials,
+}
+
+# request payload schemas, the handler rejects payloads that don't match them before authentication
+schemas = {
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.users_read.v1.0': {
+        'type': ['object', 'null'],
+        'properties': {
+            'limit': {'type': 'integer'},
+            'after': {'type': 'string'},
+        },
+    },
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_write.v1.0': {
+        'type': 'object',
+        'properties': {
+            'login': {'type': 'string'},
+            'name': {'type': 'string'},
+            'email': {'type': 'string'},
+        },
+        'required': ['login', 'name', 'email'],
+    },
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_update.v1.0': {
+        'type': 'object',
+        'properties': {
+            'id': {'type': 'string'},
+            'name': {'type': 'string'},
+            'email': {'type': 'string'},
+        },
+        'required': ['id', 'name', 'email'],
+    },
+    f'cti.a.p.acgw.callback.v1.0~{APPCODE}.user_delete.v1.0': {
+        'type': 'object',
+        'properties': {
+            'id': {'type': 'string'},
+        },
+        'required': ['id'],
+    },
+}
@@ -0,0 +1,93 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sqlite3
+import asyncio
+import logging
+from time import time
+from typing import Optional
+
+from utils import sqlite_connect, prune_change_log
+from server.auth import CredentialCache
+from server.database import Database
+from server.response_cache import ResponseCache
+
+# Above this many new changes the caches are cleared without reading which rows changed
+MAX_CHANGES = 10000
+# Tables whose changes make the cached responses stale
+RESPONSE_TABLES = ('organizations', 'organizations_mapping')
+# Seconds between prunings of the change log, so it doesn't grow when no consumer is running
+PRUNE_INTERVAL = 600
+
+
+def _read_changes(conn: sqlite3.Connection, position: int) -> tuple[int, Optional[list[sqlite3.Row]]]:
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    last_id = row['seq'] if row else 0
+    if last_id - position > MAX_CHANGES:
+        return last_id, None
+    return last_id, conn.execute('SELECT table_name, row_id FROM change_log WHERE id > ? AND id <= ?', (position, last_id)).fetchall()
+
+
+class ChangeWatcher:
+    """
+    Drops the cached credentials and responses made stale by writes of other processes, such as the other workers.
+
+    `PRAGMA data_version` changes whenever another connection commits to the database and is cheap enough to check
+    before every request. When it changes, the new rows of `change_log` tell which users to drop from the credential
+    cache and whether the cached responses are stale. If some of the rows were already pruned, or there are too many
+    of them, both caches are cleared.
+
+    One process of the server also runs `prune` in the background, so the change log doesn't grow when no consumer
+    is running and no request waits for the pruning.
+    """
+
+    def __init__(self, filename: str, db: Database, credentials: CredentialCache, responses: ResponseCache) -> None:
+        self.db = db
+        self.credentials = credentials
+        self.responses = responses
+        self._conn = sqlite_connect(filename, check_same_thread=False)
+        self._conn.execute('PRAGMA query_only=ON')
+        self._lock = asyncio.Lock()
+        self.version = self._data_version()
+        self.position = _read_changes(self._conn, 0)[0]
+
+
+    def _data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+
+    async def sync(self) -> None:
+        if self._data_version() == self.version:
+            return
+        async with self._lock:
+            version = self._data_version()
+            if version == self.version:
+                return
+            self.version = version
+            last_id, rows = await self.db.read(_read_changes, self.position)
+            if rows is None or len(rows) < last_id - self.position:
+                self.credentials.clear()
+                self.responses.clear()
+            else:
+                for row in rows:
+                    if row['table_name'] == 'users':
+                        self.credentials.invalidate_user(row['row_id'])
+                if any(row['table_name'] in RESPONSE_TABLES for row in rows):
+                    self.responses.clear()
+            self.position = last_id
+
+
+    async def prune(self) -> None:
+        """Prunes the change log every `PRUNE_INTERVAL` seconds, until cancelled."""
+        while True:
+            try:
+                await self.db.write(lambda conn: prune_change_log(conn, int(time())))
+            except Exception as e:
+                logging.warning('Failed to prune the change log: %s', e)
+            await asyncio.sleep(PRUNE_INTERVAL)
+
+
+    def close(self) -> None:
+        self._conn.close()
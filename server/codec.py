@@ -0,0 +1,71 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+"""
+JSON encoding and decoding for the callback handler.
+
+The fastest installed library is used: `orjson`, then `ujson`, then the standard `json` module.
+A specific one can be selected with `use()`. `dumps` always returns bytes.
+"""
+
+import json
+from time import perf_counter
+from aiohttp import web
+from typing import Any, Callable, NamedTuple, Optional, Union
+
+from datatypes import ResponseEnvelope
+import server.metrics as metrics
+
+
+class Codec(NamedTuple):
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Union[bytes, str]], Any]
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+AVAILABLE: dict[str, Codec] = {}
+
+try:
+    import orjson
+    AVAILABLE['orjson'] = Codec('orjson', orjson.dumps, orjson.loads)
+except ImportError:
+    pass
+
+try:
+    import ujson
+    AVAILABLE['ujson'] = Codec('ujson', lambda obj: ujson.dumps(obj, ensure_ascii=False).encode(), ujson.loads)
+except ImportError:
+    pass
+
+AVAILABLE['json'] = Codec('json', _stdlib_dumps, json.loads)
+
+codec: Codec = next(iter(AVAILABLE.values()))
+dumps = codec.dumps
+loads = codec.loads
+
+
+def use(name: str) -> None:
+    global codec, dumps, loads
+    codec = AVAILABLE[name]
+    dumps = codec.dumps
+    loads = codec.loads
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[dict] = None) -> web.Response:
+    start = perf_counter()
+    body = dumps(data)
+    metrics.add_time('serialize', perf_counter() - start)
+    return web.Response(status=status, headers=headers, body=body, content_type='application/json')
+
+
+def callback_response(envelope: ResponseEnvelope, request_id: str, response_id: str, payload: Optional[dict] = None) -> web.Response:
+    start = perf_counter()
+    body = envelope.render(request_id, response_id, None if payload is None else dumps(payload))
+    metrics.add_time('serialize', perf_counter() - start)
+    return web.Response(status=200, body=body, content_type='application/json')
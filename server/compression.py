@@ -0,0 +1,171 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import zlib
+import struct
+import asyncio
+from time import perf_counter
+from functools import lru_cache
+from typing import Callable, Hashable, NamedTuple, Optional
+from aiohttp import web, hdrs
+from aiohttp.web_response import ContentCoding
+
+import server.metrics as metrics
+from server.response_cache import ResponseCache
+
+# Bodies larger than this are compressed in a thread, so the event loop isn't blocked meanwhile
+EXECUTOR_SIZE = 64 * 1024
+# Key of the response item that tells where the cached payload is in the body, see `CachedPayload`
+CACHED_PAYLOAD = 'cached_payload'
+
+# Header and zlib header of the assembled gzip and deflate streams, the compression level in them is informational only
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_ZLIB_HEADER = b'\x78\x9c'
+
+
+class CachedPayload(NamedTuple):
+    """The part of a response body that is a payload from the `ResponseCache`, so its compressed form can be cached too."""
+    key: Hashable
+    generation: int
+    start: int
+    end: int
+
+
+def _gzip(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _deflate(data: bytes, level: int) -> bytes:
+    return zlib.compress(data, level)
+
+
+# Content codings by preference, the ones of optional libraries are used if they are installed
+CODINGS: dict[str, Callable[[bytes, int], bytes]] = {}
+
+try:
+    import zstandard
+    CODINGS['zstd'] = lambda data, level: zstandard.ZstdCompressor(level=level).compress(data)
+except ImportError:
+    pass
+
+try:
+    import brotli
+    CODINGS['br'] = lambda data, level: brotli.compress(data, quality=min(level, 11))
+except ImportError:
+    pass
+
+CODINGS['gzip'] = _gzip
+CODINGS['deflate'] = _deflate
+
+# Codings whose streams can be assembled from separately compressed parts
+_SPLICEABLE = ('gzip', 'deflate')
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding: str, available: tuple[str, ...]) -> Optional[str]:
+    """Returns the available coding the client accepts with the highest weight, the first available one on a tie."""
+    weights: dict[str, float] = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip()] = weight
+    default = weights.get('*', 0.0)
+    best, best_weight = None, 0.0
+    for coding in available:
+        weight = weights.get(coding, default)
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def _raw_deflate(data: bytes, level: int, finish: bool) -> bytes:
+    # Without finishing, the output ends at a byte boundary, so another stream of raw blocks can follow it
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+def _splice(coding: str, body: bytes, part: CachedPayload, segment: bytes, level: int) -> bytes:
+    """Compresses `body` reusing `segment`, the compressed payload at `part`. Only the text around it is compressed."""
+    view = memoryview(body)
+    prefix, payload, suffix = view[:part.start], view[part.start:part.end], view[part.end:]
+    blocks = b''.join((_raw_deflate(prefix, level, False), segment, _raw_deflate(suffix, level, True)))
+    if coding == 'gzip':
+        crc = zlib.crc32(suffix, zlib.crc32(payload, zlib.crc32(prefix)))
+        return b''.join((_GZIP_HEADER, blocks, struct.pack('<II', crc, len(body) & 0xffffffff)))
+    adler = zlib.adler32(suffix, zlib.adler32(payload, zlib.adler32(prefix)))
+    return b''.join((_ZLIB_HEADER, blocks, struct.pack('>I', adler)))
+
+
+class Compression:
+    """
+    Compresses response bodies of at least `min_size` bytes with the best coding the client accepts.
+
+    Bodies larger than `EXECUTOR_SIZE` are compressed in the default executor. When a body contains a payload from the
+    `ResponseCache`, the compressed payload is kept in a cache of its own, limited to `cache_bytes`, and only the
+    envelope around it is compressed for the next responses, the gzip and deflate streams allow to join separately
+    compressed parts. Streamed bodies are compressed by aiohttp as they are written, with gzip or deflate.
+    """
+
+    def __init__(self, min_size: int = 1024, level: int = 1, cache_bytes: int = 16 * 1024 * 1024) -> None:
+        self.segments = ResponseCache(cache_bytes)
+        self.min_size = min_size
+        self.level = level
+        self.compressed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+
+    async def compress(self, request: web.Request, res: web.StreamResponse) -> web.StreamResponse:
+        if self.level <= 0 or hdrs.CONTENT_ENCODING in res.headers or not isinstance(res, web.Response):
+            return res
+        body = res.body
+        if isinstance(body, bytes):
+            if len(body) < self.min_size:
+                return res
+            res.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+            coding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ''), tuple(CODINGS))
+            if coding is None:
+                return res
+            start = perf_counter()
+            res.body = await self._compress_body(coding, body, res.get(CACHED_PAYLOAD))
+            metrics.add_time('serialize', perf_counter() - start)
+            res.headers[hdrs.CONTENT_ENCODING] = coding
+            self.compressed += 1
+            self.input_bytes += len(body)
+            self.output_bytes += len(res.body)
+        elif body is not None:
+            # The size of a streamed body isn't known in advance, they are only streamed when they can be large
+            res.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+            coding = negotiate(request.headers.get(hdrs.ACCEPT_ENCODING, ''), _SPLICEABLE)
+            if coding is not None:
+                res.enable_compression(ContentCoding(coding))
+                self.compressed += 1
+        return res
+
+
+    async def _compress_body(self, coding: str, body: bytes, part: Optional[CachedPayload]) -> bytes:
+        if part is None or coding not in _SPLICEABLE:
+            return await self._run(CODINGS[coding], body, self.level, size=len(body))
+
+        # A payload of a newer generation is a different payload, the segments of older ones are left to be evicted
+        key = (part.key, part.generation)
+        segment = self.segments.get(key)
+        if segment is None:
+            segment = await self._run(_raw_deflate, memoryview(body)[part.start:part.end], self.level, False, size=part.end - part.start)
+            self.segments.put(key, segment, self.segments.generation)
+        return _splice(coding, body, part, segment, self.level)
+
+
+    async def _run(self, fn: Callable[..., bytes], *args, size: int) -> bytes:
+        if size > EXECUTOR_SIZE:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+        return fn(*args)
@@ -0,0 +1,125 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sqlite3
+import asyncio
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from utils import sqlite_connect
+import server.metrics as metrics
+from server.query_log import QueryLog, instrumented_connect
+
+T = TypeVar('T')
+
+
+class Database:
+    """
+    Asynchronous access to the SQLite database.
+
+    Reads run in a pool of threads, each with its own read-only connection, so they proceed in parallel thanks to WAL.
+    Writes are serialized through a single thread that owns the only writing connection. Every write function runs in
+    its own transaction that is committed on return and rolled back on exception.
+
+    Each connection counts the operations it ran and the time they took, `stats()` sums them up by connection kind.
+    With a `query_log` the connections also time every statement they run, see `server.query_log`.
+    """
+
+    def __init__(self, filename: str, readers: int = 4, query_log: Optional[QueryLog] = None) -> None:
+        self.filename = filename
+        self.query_log = query_log
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[sqlite3.Connection] = []
+        self._stats: list[tuple[str, list]] = []
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='sqlite-reader', initializer=self._connect, initargs=(True,))
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='sqlite-writer', initializer=self._connect, initargs=(False,))
+
+
+    def _connect(self, readonly: bool) -> None:
+        if self.query_log is None:
+            conn = sqlite_connect(self.filename, check_same_thread=False)
+        else:
+            conn = instrumented_connect(self.filename, self.query_log, check_same_thread=False)
+        if readonly:
+            conn.execute('PRAGMA query_only=ON')
+        self._local.conn = conn
+        self._local.stats = [0, 0.0]
+        with self._lock:
+            self._connections.append(conn)
+            self._stats.append(('read' if readonly else 'write', self._local.stats))
+
+
+    def _read(self, fn: Callable[..., T], args: tuple) -> T:
+        stats = self._local.stats
+        start = perf_counter()
+        try:
+            return fn(self._local.conn, *args)
+        finally:
+            stats[0] += 1
+            stats[1] += perf_counter() - start
+
+
+    def _write(self, fn: Callable[..., T], args: tuple) -> T:
+        conn: sqlite3.Connection = self._local.conn
+        stats = self._local.stats
+        start = perf_counter()
+        try:
+            with conn:
+                return fn(conn, *args)
+        finally:
+            stats[0] += 1
+            stats[1] += perf_counter() - start
+
+
+    async def _run(self, executor: ThreadPoolExecutor, run: Callable[..., T], fn: Callable[..., T], args: tuple) -> T:
+        start = perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, run, fn, args)
+        finally:
+            metrics.add_time('db', perf_counter() - start)
+
+
+    async def read(self, fn: Callable[..., T], *args) -> T:
+        """Runs `fn(conn, *args)` on one of the reader connections."""
+        return await self._run(self._readers, self._read, fn, args)
+
+
+    async def write(self, fn: Callable[..., T], *args) -> T:
+        """Runs `fn(conn, *args)` on the writer connection in a transaction."""
+        return await self._run(self._writer, self._write, fn, args)
+
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Runs a single modifying statement and returns the number of changed rows."""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+
+    def stats(self) -> dict[str, tuple[int, float]]:
+        """Returns the number of operations and the seconds spent running them by `read` and `write` connections."""
+        totals = {'read': (0, 0.0), 'write': (0, 0.0)}
+        with self._lock:
+            for kind, (count, seconds) in self._stats:
+                totals[kind] = (totals[kind][0] + count, totals[kind][1] + seconds)
+        return totals
+
+
+    def close(self) -> None:
+        self._readers.shutdown()
+        self._writer.shutdown()
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
@@ -3,68 +3,265 @@
 # This source code is distributed under MIT software license.
 # ************************************************************
 
-import json
 import logging
-import traceback
-import sqlite3
 from uuid import uuid4
+from functools import partial
+from time import perf_counter
 from base64 import b64decode
 from aiohttp import web
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 
+from argon2.exceptions import VerificationError, InvalidHashError
 from datatypes import *
-from utils import verify
-from server.callbacks import CALLBACKS_MAPPING
+from server.auth import PasswordVerifier, CredentialCache
+from server.database import Database
+import server.codec as codec
+from server.response_cache import ResponseCache
+from server.idempotency import IdempotencyCache, IdempotencyStore
+from server.compression import Compression, CachedPayload, CACHED_PAYLOAD
+from server.admission import AdmissionControl, Limiter, Overloaded, CLASSES
+from server.request_log import CallbackLogPolicy, Truncated
+from server.metrics import Metrics, CallbackTimer, add_time
+from server.callbacks import CALLBACKS_MAPPING, PAYLOAD_VALIDATORS, validate_request, CACHED_CALLBACKS, CREDENTIALS_INVALIDATING_CALLBACKS, RESPONSES_INVALIDATING_CALLBACKS, WRITE_CALLBACKS
 
 
-def _get_authenticated_user(db: sqlite3.Connection, identity: str, password: str) -> Optional[dict]:
-    row = db.execute('SELECT id, organization_id, password FROM users WHERE login = ? AND password IS NOT NULL', (identity.lower(),)).fetchone()
-    verify(row['password'], password)
-    return { 'id': row['id'], 'organization_id': row['organization_id'] }
+async def _get_authenticated_user(db: Database, verifier: PasswordVerifier, cache: CredentialCache, limiter: Limiter, identity: str, password: str) -> Optional[dict]:
+    key = cache.key(identity, password)
+    found, user = cache.get(key)
+    if found:
+        return user
+
+    async with limiter.slot():
+        row = await db.fetchone('SELECT id, organization_id, password FROM users WHERE login = ? AND password IS NOT NULL', (identity.lower(),))
+        user = None
+        if row:
+            try:
+                await verifier.verify(row['password'], password)
+                user = { 'id': row['id'], 'organization_id': row['organization_id'] }
+            except (VerificationError, InvalidHashError):
+                pass
+    cache.put(key, user)
+    return user
+
+
+def _busy_response(response_id: str, retry_after: str) -> web.Response:
+    return codec.json_response({'response_id': response_id, 'message': 'Service is busy, try again later.'}, status=503, headers={'Retry-After': retry_after})
+
+
+async def _cached_callback(cache: ResponseCache, db: Database, callback_id: str, organization_id: str, request_id: str, response_id: str, context: CallbackContext) -> web.Response:
+    envelope, read_payload = CACHED_CALLBACKS[callback_id]
+    key = (callback_id, organization_id, context['datacenter_url'])
+    payload = cache.get(key)
+    generation = cache.generation
+    if payload is None:
+        data = await read_payload(db, organization_id, context)
+        start = perf_counter()
+        payload = codec.dumps(data)
+        add_time('serialize', perf_counter() - start)
+        cache.put(key, payload, generation)
+    start = perf_counter()
+    body = envelope.render(request_id, response_id, payload)
+    add_time('serialize', perf_counter() - start)
+    res = web.Response(status=200, body=body, content_type='application/json')
+    # The payload is followed by the closing brace of the envelope
+    res[CACHED_PAYLOAD] = CachedPayload(key, generation, len(body) - len(payload) - 1, len(body) - 1)
+    return res
 
 
 async def index(_: web.Request) -> web.Response:
     return web.Response(text='Hello there! Send POST requests to the /callback endpoint.', content_type='text/plain')
 
 
+async def metrics_handler(request: web.Request) -> web.Response:
+    app = request.app
+    db_stats = app['db'].stats()
+    query_log = app['db'].query_log
+    statements, statement_seconds = query_log.totals() if query_log is not None else (0, 0.0)
+    responses: ResponseCache = app['responses']
+    idempotency: IdempotencyCache = app['idempotency']
+    compression: Compression = app['compression']
+    admission: AdmissionControl = app['admission']
+    text = app['metrics'].render((
+        ('cyberapp_db_operations_total', 'counter', 'Database reads and write transactions by connection kind, one can run several statements.', {'kind': 'read'}, db_stats['read'][0]),
+        ('cyberapp_db_operations_total', 'counter', 'Database reads and write transactions by connection kind, one can run several statements.', {'kind': 'write'}, db_stats['write'][0]),
+        ('cyberapp_db_operation_seconds_total', 'counter', 'Time spent running database reads and write transactions.', {'kind': 'read'}, db_stats['read'][1]),
+        ('cyberapp_db_operation_seconds_total', 'counter', 'Time spent running database reads and write transactions.', {'kind': 'write'}, db_stats['write'][1]),
+        ('cyberapp_db_statements_total', 'counter', 'SQLite statements run.', None, statements),
+        ('cyberapp_db_statement_seconds_total', 'counter', 'Time spent running SQLite statements and fetching their rows.', None, statement_seconds),
+        ('cyberapp_credential_cache_entries', 'gauge', 'Cached credential verifications.', None, len(app['credentials'].entries)),
+        ('cyberapp_response_cache_hits_total', 'counter', 'Response cache hits.', None, responses.hits),
+        ('cyberapp_response_cache_misses_total', 'counter', 'Response cache misses.', None, responses.misses),
+        ('cyberapp_response_cache_evictions_total', 'counter', 'Response cache evictions.', None, responses.evictions),
+        ('cyberapp_response_cache_bytes', 'gauge', 'Size of cached responses.', None, responses.size),
+        ('cyberapp_idempotency_hits_total', 'counter', 'Retried requests answered with a stored response.', None, idempotency.hits),
+        ('cyberapp_idempotency_coalesced_total', 'counter', 'Retried requests that waited for the same request in progress.', None, idempotency.coalesced),
+        ('cyberapp_idempotency_store_hits_total', 'counter', 'Retried write requests answered with a response stored in the database.', None, app['idempotency_store'].hits),
+        ('cyberapp_idempotency_bytes', 'gauge', 'Size of stored responses to completed requests.', None, idempotency.size),
+        ('cyberapp_compressed_responses_total', 'counter', 'Responses sent compressed.', None, compression.compressed),
+        ('cyberapp_compression_bytes_total', 'counter', 'Size of compressed response bodies before and after compression, streamed bodies are not counted.', {'stage': 'input'}, compression.input_bytes),
+        ('cyberapp_compression_bytes_total', 'counter', 'Size of compressed response bodies before and after compression, streamed bodies are not counted.', {'stage': 'output'}, compression.output_bytes),
+        *(('cyberapp_admission_in_flight', 'gauge', 'Admitted requests running by callback class.', {'class': name}, admission[name].in_flight) for name in CLASSES),
+        *(('cyberapp_admission_queue_depth', 'gauge', 'Requests waiting for admission by callback class.', {'class': name}, len(admission[name].waiters)) for name in CLASSES),
+        *(('cyberapp_admission_shed_total', 'counter', 'Requests rejected with 503 by callback class and reason.', {'class': name, 'reason': reason}, count) for name in CLASSES for reason, count in admission[name].shed.items()),
+    ))
+    return web.Response(text=text, content_type='text/plain')
+
+
+def _is_streamed(res: web.StreamResponse) -> bool:
+    return isinstance(res, web.Response) and res.body is not None and not isinstance(res.body, bytes)
+
+
+async def _send_stream(request: web.Request, res: web.Response) -> None:
+    """
+    Writes a streamed body before the handler returns rather than after, so reading and encoding it are timed and
+    the admission slot of the callback is held until the body is sent.
+    """
+    res = await request.app['compression'].compress(request, res)
+    await res.prepare(request)
+    await res.write_eof()
+
+
 async def callback_handler(request: web.Request) -> web.Response:
+    metrics: Metrics = request.app['metrics']
+    timer = metrics.start()
+    status = 500
+    try:
+        res = await _handle_callback(request, timer)
+        # Streamed responses are sent by `_run_callback` already
+        if not res.prepared:
+            compression: Compression = request.app['compression']
+            res = await compression.compress(request, res)
+        status = res.status
+        return res
+    finally:
+        metrics.finish(timer, status)
+
+
+async def _handle_callback(request: web.Request, timer: CallbackTimer) -> web.Response:
     if not request.content_type.startswith('application/json'):
-        logging.info(f'Received non-JSON request')
+        logging.info('Received non-JSON request')
         return web.Response(status=400)
 
     response_id = str(uuid4())
-    data: CallbackRequest = await request.json()
-    logging.info(f'Received data {data}')
+    policy: CallbackLogPolicy = request.app['request_log']
+    body = await request.read()
     try:
-        callback_id = data['context']['callback_id']
-        if callback_id not in CALLBACKS_MAPPING:
-            logging.info(f'Callback not found.')
-            return web.json_response(status=400, data={'response_id': response_id, 'message': 'Callback not found.'})
+        start = perf_counter()
+        data: CallbackRequest = codec.loads(body)
+        error = validate_request(data)
+        timer.phases['parse'] = perf_counter() - start
     except:
-        logging.info(f'Received malformed callback request.')
-        logging.info(traceback.format_exc())
-        return web.json_response(status=400, data={'response_id': response_id, 'message': 'Received malformed callback request.'})
+        logging.info('Received malformed callback request %s', Truncated(body, policy.default[1]), exc_info=True)
+        return codec.json_response({'response_id': response_id, 'message': 'Received malformed callback request.'}, status=400)
+    if error:
+        logging.info('Received malformed callback request %s. Reason: %s', Truncated(body, policy.default[1]), error)
+        return codec.json_response({'response_id': response_id, 'message': f'Received malformed callback request: {error}.'}, status=400)
+
+    callback_id = data['context']['callback_id']
+    if callback_id not in CALLBACKS_MAPPING:
+        logging.info('Callback not found: %s', callback_id)
+        return codec.json_response({'response_id': response_id, 'message': 'Callback not found.'}, status=400)
+    timer.callback_id = callback_id
+
+    log_body = policy.sample(callback_id)
+    if log_body:
+        logging.info('Received data %s', Truncated(body, log_body), extra={'callback_id': callback_id, 'response_id': response_id})
+
+    # Checked before authentication, so malformed requests don't cost a password verification or database reads
+    validate_payload = PAYLOAD_VALIDATORS.get(callback_id)
+    if validate_payload is not None:
+        start = perf_counter()
+        error = validate_payload(data.get('payload', {}))
+        timer.phases['parse'] += perf_counter() - start
+        if error:
+            logging.info('Received invalid payload. Reason: %s', error, extra={'callback_id': callback_id, 'response_id': response_id})
+            return codec.json_response({'response_id': response_id, 'message': f'Invalid payload: {error}.'}, status=400)
+
+    # An overloaded class is rejected before authentication, so shedding doesn't cost a password verification
+    admission: AdmissionControl = request.app['admission']
+    try:
+        admission['write' if callback_id in WRITE_CALLBACKS else 'read'].check()
+    except Overloaded as e:
+        logging.info('Rejected callback. Reason: %s', e, extra={'callback_id': callback_id, 'response_id': response_id})
+        return _busy_response(response_id, e.retry_after_header)
 
     try:
         raw_creds = b64decode(request.headers['X-CyberApp-Auth']).decode()
         sep_idx = raw_creds.index(':')
-        identity, secrets = [raw_creds[:sep_idx], json.loads(raw_creds[sep_idx + 1:])]
+        identity, secrets = [raw_creds[:sep_idx], codec.loads(raw_creds[sep_idx + 1:])]
+        password = secrets['password']
         # extra = json.loads(b64decode(request.headers['X-CyberApp-Extra']).decode())
+    except Exception as e:
+        logging.info('Failed to authenticate user. Reason: %s', e, exc_info=True, extra={'callback_id': callback_id, 'response_id': response_id})
+        return codec.json_response({'response_id': response_id, 'message': f'Failed to authenticate user.'}, status=401)
+
+    run = partial(_run_callback, request, timer, data, callback_id, response_id, identity, password, log_body)
+    if callback_id in CACHED_CALLBACKS:
+        # Their payloads are in the `ResponseCache` already
+        return await run()
+    # A retried request gets the stored response of the first one, if it was sent with the same credentials
+    idempotency: IdempotencyCache = request.app['idempotency']
+    return await idempotency.run((data['request_id'], callback_id, request.app['credentials'].key(identity, password)), run)
+
 
-        with request.app['db'] as conn:
-            row = _get_authenticated_user(conn, identity, secrets['password'])
+async def _run_callback(request: web.Request, timer: CallbackTimer, data: CallbackRequest, callback_id: str, response_id: str, identity: str, password: str, log_body: int) -> web.Response:
+    await request.app['changes'].sync()
+
+    admission: AdmissionControl = request.app['admission']
+    start, db_time = perf_counter(), timer.phases['db']
+    try:
+        row = await _get_authenticated_user(request.app['db'], request.app['verifier'], request.app['credentials'], admission['auth'], identity, password)
+        if not row:
+            raise Exception('Invalid credentials')
+    except Overloaded as e:
+        logging.info('Rejected authentication. Reason: %s', e, extra={'callback_id': callback_id, 'response_id': response_id})
+        return _busy_response(response_id, e.retry_after_header)
     except Exception as e:
-        logging.info(f'Failed to authenticate user. Reason: {e}')
-        logging.info(traceback.format_exc())
-        return web.json_response(status=401, data={'response_id': response_id, 'message': f'Failed to authenticate user.'})
-    
+        logging.info('Failed to authenticate user. Reason: %s', e, exc_info=True, extra={'callback_id': callback_id, 'response_id': response_id})
+        return codec.json_response({'response_id': response_id, 'message': f'Failed to authenticate user.'}, status=401)
+    finally:
+        timer.phases['auth'] = perf_counter() - start - (timer.phases['db'] - db_time)
+
+    limiter = admission['write' if callback_id in WRITE_CALLBACKS else 'read']
+    try:
+        res = await _admitted(request, limiter, partial(_execute_callback, request, data, callback_id, response_id, row['id'], row['organization_id'], log_body))
+    except Overloaded as e:
+        logging.info('Rejected callback. Reason: %s', e, extra={'callback_id': callback_id, 'response_id': response_id})
+        res = _busy_response(response_id, e.retry_after_header)
+    return res
+
+
+async def _admitted(request: web.Request, limiter: Limiter, execute: Callable[[], Awaitable[web.Response]]) -> web.Response:
+    async with limiter.slot():
+        res = await execute()
+        # The pages of a streamed body after the first are read while it's written, errors then abort the connection
+        if _is_streamed(res):
+            await _send_stream(request, res)
+    return res
+
+
+async def _execute_callback(request: web.Request, data: CallbackRequest, callback_id: str, response_id: str, user_id: str, organization_id: str, log_body: int) -> web.Response:
     payload = data.get('payload', {})
-    with request.app['db'] as conn:
-        try:
-            res = CALLBACKS_MAPPING[callback_id](conn, row['organization_id'], data['request_id'], response_id, data['context'], payload)
-            logging.info(f'Response data: {res.body}')
-        except Exception as e:
-            res = web.json_response(status=500, data={'response_id': response_id, 'message': f'Failed to make proper response. Reason: {e}'})
-            logging.info(f'Failed to make proper response. Reason: {e}')
-            logging.info(traceback.format_exc())
+    try:
+        if callback_id in CACHED_CALLBACKS:
+            res = await _cached_callback(request.app['responses'], request.app['db'], callback_id, organization_id, data['request_id'], response_id, data['context'])
+        elif callback_id in WRITE_CALLBACKS:
+            # The other workers keep their own `IdempotencyCache`, a retried write finds the response in the database
+            store: IdempotencyStore = request.app['idempotency_store']
+            write = CALLBACKS_MAPPING[callback_id]
+            res = await store.run(
+                (data['request_id'], callback_id, user_id),
+                lambda conn: write(conn, organization_id, data['request_id'], response_id, data['context'], payload)
+            )
+        else:
+            res = await CALLBACKS_MAPPING[callback_id](request.app['db'], organization_id, data['request_id'], response_id, data['context'], payload)
+        if log_body and isinstance(res.body, bytes):
+            logging.info('Response data: %s', Truncated(res.body, log_body), extra={'callback_id': callback_id, 'response_id': response_id, 'status': res.status})
+        if callback_id in CREDENTIALS_INVALIDATING_CALLBACKS and res.status == 200:
+            request.app['credentials'].invalidate_user(payload['id'])
+        if callback_id in RESPONSES_INVALIDATING_CALLBACKS and res.status == 200:
+            request.app['responses'].clear()
+    except Exception as e:
+        res = codec.json_response({'response_id': response_id, 'message': f'Failed to make proper response. Reason: {e}'}, status=500)
+        logging.info('Failed to make proper response. Reason: %s', e, exc_info=True, extra={'callback_id': callback_id, 'response_id': response_id})
     return res
@@ -0,0 +1,154 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import sqlite3
+import asyncio
+import logging
+from time import monotonic, time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable, NamedTuple, Optional
+from aiohttp import web
+
+from server.database import Database
+
+# Seconds between deletions of expired responses from the database
+PRUNE_INTERVAL = 60
+
+
+class StoredResponse(NamedTuple):
+    expires: float
+    status: int
+    content_type: str
+    body: bytes
+
+
+def _storable(res: web.StreamResponse) -> bool:
+    return res.status < 500 and res.status != 401 and isinstance(res, web.Response) and isinstance(res.body, bytes)
+
+
+class IdempotencyCache:
+    """
+    Remembers the responses to callback requests, so that a retried request gets the same response without running again.
+
+    The key identifies the request together with the credentials it was sent with, so a stored response is never
+    returned to a different user. Responses with a body in memory are kept for `ttl` seconds within a budget of
+    `max_bytes`; streamed responses, failed authentication and server errors are not kept. Requests with the key of
+    a request that is still running wait for its response instead of running at the same time.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 300) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.entries: OrderedDict[Hashable, StoredResponse] = OrderedDict()
+        self.running: dict[Hashable, asyncio.Future] = {}
+
+
+    async def run(self, key: Hashable, handler: Callable[[], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+        if self.max_bytes <= 0:
+            return await handler()
+
+        while True:
+            stored = self._get(key)
+            if stored is not None:
+                self.hits += 1
+                return web.Response(status=stored.status, body=stored.body, content_type=stored.content_type)
+            running = self.running.get(key)
+            if running is None:
+                break
+            self.coalesced += 1
+            # The same request is running, its response is stored when it completes. If it's not, this one runs itself.
+            await asyncio.shield(running)
+
+        done = self.running[key] = asyncio.get_running_loop().create_future()
+        try:
+            res = await handler()
+            if _storable(res):
+                self._put(key, StoredResponse(monotonic() + self.ttl, res.status, res.content_type, res.body))
+            return res
+        finally:
+            del self.running[key]
+            done.set_result(None)
+
+
+    def _get(self, key: Hashable) -> Optional[StoredResponse]:
+        stored = self.entries.get(key)
+        if stored is None:
+            return None
+        if stored.expires < monotonic():
+            self._remove(key)
+            return None
+        return stored
+
+
+    def _put(self, key: Hashable, stored: StoredResponse) -> None:
+        if len(stored.body) > self.max_bytes:
+            return
+        self._remove(key)
+        self.entries[key] = stored
+        self.size += len(stored.body)
+        # Entries are added in the order they expire, so the oldest ones go first
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+
+    def _remove(self, key: Hashable) -> None:
+        stored = self.entries.pop(key, None)
+        if stored is not None:
+            self.size -= len(stored.body)
+
+
+class IdempotencyStore:
+    """
+    Keeps the responses to write callbacks in the database for `ttl` seconds, so a retried write is not applied twice
+    even when it reaches another worker or the server was restarted in between.
+
+    The stored response is looked up, the write is applied and its response is stored in one transaction that takes
+    the write lock first. A retry running at the same time in another process waits for the lock and then finds the
+    response, and a crash can't leave a write applied without its response. A write that fails is rolled back and
+    its retry runs again.
+    """
+
+    def __init__(self, db: Database, ttl: float = 300) -> None:
+        self.db = db
+        self.ttl = ttl
+        self.hits = 0
+
+
+    async def run(self, key: tuple[str, ...], write: Callable[[sqlite3.Connection], web.Response]) -> web.Response:
+        """Returns the stored response of the request with the key, or runs `write(conn)` on the writer connection and stores its response."""
+        if self.ttl <= 0:
+            return await self.db.write(write)
+
+        key = '\0'.join(key)
+
+        def run(conn: sqlite3.Connection) -> tuple[bool, web.Response]:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time()
+            row = conn.execute('SELECT status, content_type, body FROM callback_responses WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is not None:
+                return True, web.Response(status=row['status'], body=row['body'], content_type=row['content_type'])
+            res = write(conn)
+            if _storable(res):
+                conn.execute('INSERT OR REPLACE INTO callback_responses (key, expires_at, status, content_type, body) VALUES (?,?,?,?,?)',
+                    (key, now + self.ttl, res.status, res.content_type, res.body))
+            return False, res
+
+        stored, res = await self.db.write(run)
+        if stored:
+            self.hits += 1
+        return res
+
+
+    async def prune(self) -> None:
+        """Deletes expired responses every `PRUNE_INTERVAL` seconds, until cancelled."""
+        while True:
+            try:
+                await self.db.execute('DELETE FROM callback_responses WHERE expires_at <= ?', (time(),))
+            except Exception as e:
+                logging.warning('Failed to prune the callback responses: %s', e)
+            await asyncio.sleep(PRUNE_INTERVAL)
@@ -0,0 +1,139 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+"""
+Callback handler instrumentation exposed in the Prometheus text format.
+
+Every callback request gets a `CallbackTimer` that is made current for the request task. The time spent in the
+database and in encoding is added to the current timer by `Database` and `server.codec`, so the callbacks themselves
+don't need to know about metrics. Parse and auth time are measured by the handler.
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+PHASES = ('parse', 'auth', 'db', 'serialize')
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNKNOWN_CALLBACK = 'unknown'
+
+_current: ContextVar[Optional['CallbackTimer']] = ContextVar('callback_timer', default=None)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class CallbackTimer:
+    """Phase durations of a single callback request, in seconds."""
+
+    __slots__ = ('callback_id', 'start', 'phases')
+
+    def __init__(self) -> None:
+        self.callback_id = UNKNOWN_CALLBACK
+        self.start = perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+
+
+def add_time(phase: str, seconds: float) -> None:
+    """Adds `seconds` to a phase of the callback request being handled in the current task, if any."""
+    timer = _current.get()
+    if timer is not None:
+        timer.phases[phase] += seconds
+
+
+class Metrics:
+    """Latency histograms per callback and phase, in-flight requests and responses by status."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.responses: dict[tuple[str, int], int] = {}
+
+
+    def start(self) -> CallbackTimer:
+        timer = CallbackTimer()
+        _current.set(timer)
+        self.in_flight += 1
+        return timer
+
+
+    def finish(self, timer: CallbackTimer, status: int) -> None:
+        self.in_flight -= 1
+        _current.set(None)
+        callback_id = timer.callback_id
+        self._observe(callback_id, 'total', perf_counter() - timer.start)
+        for phase, seconds in timer.phases.items():
+            self._observe(callback_id, phase, seconds)
+        key = (callback_id, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+
+
+    def _observe(self, callback_id: str, phase: str, seconds: float) -> None:
+        histogram = self.histograms.get((callback_id, phase))
+        if histogram is None:
+            histogram = self.histograms[(callback_id, phase)] = Histogram()
+        histogram.observe(seconds)
+
+
+    def render(self, extra: Iterable[tuple[str, str, str, dict, float]] = ()) -> str:
+        """
+        Returns all metrics in the Prometheus text format.
+
+        `extra` are additional samples as `(name, type, help, labels, value)`, samples of one metric must be adjacent.
+        """
+        lines = [
+            '# HELP cyberapp_callback_seconds Callback request latency by phase, total is the whole request.',
+            '# TYPE cyberapp_callback_seconds histogram',
+        ]
+        for (callback_id, phase), histogram in sorted(self.histograms.items()):
+            labels = _labels({'callback_id': callback_id, 'phase': phase})
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'cyberapp_callback_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += histogram.counts[-1]
+            lines.append(f'cyberapp_callback_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'cyberapp_callback_seconds_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'cyberapp_callback_seconds_count{{{labels}}} {cumulative}')
+
+        lines.append('# HELP cyberapp_callback_responses_total Callback responses by status.')
+        lines.append('# TYPE cyberapp_callback_responses_total counter')
+        for (callback_id, status), count in sorted(self.responses.items()):
+            lines.append(f'cyberapp_callback_responses_total{{{_labels({"callback_id": callback_id, "status": status})}}} {count}')
+
+        lines.append('# HELP cyberapp_callbacks_in_flight Callback requests being handled.')
+        lines.append('# TYPE cyberapp_callbacks_in_flight gauge')
+        lines.append(f'cyberapp_callbacks_in_flight {self.in_flight}')
+
+        described = None
+        for name, type, help, labels, value in extra:
+            if name != described:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {type}')
+                described = name
+            if labels:
+                lines.append(f'{name}{{{_labels(labels)}}} {value}')
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: dict) -> str:
+    return ','.join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,204 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import re
+import sqlite3
+import logging
+import threading
+from time import perf_counter
+from functools import lru_cache
+from typing import Optional
+
+from utils import sqlite_connect
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    """Returns the statement with literals replaced by `?`, lists of parameters shortened to `(...)` and whitespace collapsed."""
+    sql = _LITERALS.sub('?', sql)
+    sql = _PARAMETER_LISTS.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+def _full_scans(plan: list[str]) -> list[str]:
+    # Scans that use an index only read the part of the table they need or avoid reading it at all
+    return [detail for detail in plan if detail.startswith('SCAN ') and ' INDEX ' not in detail and detail != 'SCAN CONSTANT ROW']
+
+
+class QueryLog:
+    """
+    Statistics of the statements run on instrumented connections, aggregated by normalized SQL.
+
+    Statements that take longer than `slow_seconds` are logged with their query plan. With `explain` every statement
+    is explained the first time it runs, and the ones that scan a whole table are logged then and marked in `report()`.
+    """
+
+    def __init__(self, slow_seconds: float = 0, explain: bool = False) -> None:
+        self.slow_seconds = slow_seconds
+        self.explain = explain
+        # Normalized SQL -> [count, total seconds, max seconds, query plan or None if not explained]
+        self.statements: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+
+    def started(self, conn: sqlite3.Connection, sql: str, params) -> list:
+        """Counts a run of `sql` and returns the entry its time is added to. Explains statements seen for the first time."""
+        key = normalize(sql)
+        entry = self.statements.get(key)
+        if entry is None:
+            plan = _explain(conn, sql, params) if self.explain else None
+            with self._lock:
+                entry = self.statements.setdefault(key, [0, 0.0, 0.0, plan])
+            if plan and _full_scans(plan):
+                logging.warning('Full table scan in %s: %s', key, '; '.join(plan), extra={'sql': key, 'plan': plan})
+        with self._lock:
+            entry[0] += 1
+        return entry
+
+
+    def add_time(self, entry: list, seconds: float, elapsed: float) -> None:
+        """Adds `seconds` spent in a run of the statement of `entry` that took `elapsed` seconds so far."""
+        with self._lock:
+            entry[1] += seconds
+            entry[2] = max(entry[2], elapsed)
+
+
+    def totals(self) -> tuple[int, float]:
+        """Returns the number of statements run and the seconds spent running them and fetching their rows."""
+        with self._lock:
+            entries = list(self.statements.values())
+        return sum(entry[0] for entry in entries), sum(entry[1] for entry in entries)
+
+
+    def slow(self, conn: sqlite3.Connection, sql: str, params, elapsed: float) -> None:
+        key, plan = normalize(sql), _explain(conn, sql, params)
+        logging.warning('Slow query took %.1f ms: %s; plan: %s', elapsed * 1000, key, '; '.join(plan),
+            extra={'sql': key, 'duration_ms': round(elapsed * 1000, 1), 'plan': plan})
+
+
+    def report(self) -> list[dict]:
+        """Returns the statistics of every statement, the ones that took the most time in total first."""
+        with self._lock:
+            items = [(sql, *entry) for sql, entry in self.statements.items()]
+        return [
+            {
+                'sql': sql,
+                'count': count,
+                'total_ms': round(total * 1000, 1),
+                'avg_ms': round(total * 1000 / count, 3) if count else 0,
+                'max_ms': round(longest * 1000, 1),
+                **({'plan': plan, 'full_scan': bool(_full_scans(plan))} if plan is not None else {}),
+            }
+            for sql, count, total, longest, plan in sorted(items, key=lambda item: item[2], reverse=True)
+        ]
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params) -> list[str]:
+    # The base class method, so that explaining isn't instrumented itself
+    try:
+        rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[3] for row in rows]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Reports the time spent running a statement and fetching its rows to the connection's `QueryLog`.
+    The time of a run adds up over the fetches, so a statement is logged as slow as soon as it crosses the threshold.
+    """
+
+    _entry: Optional[list] = None
+
+
+    def execute(self, sql: str, params=()):
+        return self._run(super().execute, sql, params, params)
+
+
+    def executemany(self, sql: str, seq_of_params):
+        # Parameters can be a generator, so they aren't kept for explaining the statement
+        return self._run(super().executemany, sql, seq_of_params, None)
+
+
+    def _run(self, run, sql: str, params, explain_params):
+        self._sql, self._params, self._elapsed, self._logged = sql, explain_params, 0.0, False
+        self._entry = self.connection.query_log.started(self.connection, sql, explain_params)
+        start = perf_counter()
+        try:
+            run(sql, params)
+        finally:
+            self._add(perf_counter() - start)
+        return self
+
+
+    def fetchone(self):
+        start = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._add(perf_counter() - start)
+
+
+    def fetchmany(self, size: Optional[int] = None):
+        start = perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._add(perf_counter() - start)
+
+
+    def fetchall(self):
+        start = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._add(perf_counter() - start)
+
+
+    def __next__(self):
+        start = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._add(perf_counter() - start)
+
+
+    def _add(self, seconds: float) -> None:
+        if self._entry is None:
+            return
+        log: QueryLog = self.connection.query_log
+        self._elapsed += seconds
+        log.add_time(self._entry, seconds, self._elapsed)
+        if log.slow_seconds and self._elapsed >= log.slow_seconds and not self._logged:
+            self._logged = True
+            log.slow(self.connection, self._sql, self._params, self._elapsed)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Not set yet while `sqlite_connect` configures the connection
+    query_log: Optional[QueryLog] = None
+
+
+    def execute(self, sql: str, params=()):
+        if self.query_log is None:
+            return super().execute(sql, params)
+        return self.cursor(InstrumentedCursor).execute(sql, params)
+
+
+    def executemany(self, sql: str, seq_of_params):
+        if self.query_log is None:
+            return super().executemany(sql, seq_of_params)
+        return self.cursor(InstrumentedCursor).executemany(sql, seq_of_params)
+
+
+def instrumented_connect(filename: str, query_log: QueryLog, **kwargs) -> InstrumentedConnection:
+    """`sqlite_connect` that reports every statement to `query_log`."""
+    conn = sqlite_connect(filename, factory=InstrumentedConnection, **kwargs)
+    conn.query_log = query_log
+    return conn
@@ -0,0 +1,68 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+from random import random
+from typing import Mapping, Optional, Union
+
+REDACTED_HEADERS = {'x-cyberapp-auth', 'x-cyberapp-extra', 'authorization', 'cookie'}
+
+
+class Truncated:
+    """Request or response body cut to `limit` bytes, decoded only when the record is written."""
+
+    __slots__ = ('body', 'size')
+
+    def __init__(self, body: Union[bytes, str], limit: int) -> None:
+        self.size = len(body)
+        self.body = body[:limit]
+
+
+    def __str__(self) -> str:
+        text = self.body.decode(errors='replace') if isinstance(self.body, bytes) else self.body
+        if self.size > len(self.body):
+            text += f'... ({self.size} bytes)'
+        return text
+
+
+class Redacted:
+    """Headers with credentials replaced, rendered only when the record is written."""
+
+    __slots__ = ('headers',)
+
+    def __init__(self, headers: Mapping[str, str]) -> None:
+        self.headers = headers
+
+
+    def __str__(self) -> str:
+        return str({key: '<redacted>' if key.lower() in REDACTED_HEADERS else value for key, value in self.headers.items()})
+
+
+class CallbackLogPolicy:
+    """
+    Decides whether request and response bodies of a callback are logged and how much of them.
+
+    `sample_rate` is the share of requests that are logged, `max_body` is the number of body bytes kept.
+    Both can be overridden for separate callback IDs.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, max_body: int = 2048, overrides: dict[str, tuple[float, Optional[int]]] = None) -> None:
+        self.default = (sample_rate, max_body)
+        self.overrides = overrides or {}
+
+
+    def sample(self, callback_id: str) -> int:
+        """Returns the number of body bytes to log for this request, 0 if the request is not logged."""
+        sample_rate, max_body = self.overrides.get(callback_id, self.default)
+        if sample_rate >= 1 or random() < sample_rate:
+            return self.default[1] if max_body is None else max_body
+        return 0
+
+
+    @staticmethod
+    def parse_override(value: str) -> tuple[str, tuple[float, Optional[int]]]:
+        """Parses `<callback_id>=<sample_rate>[,<max_body>]`."""
+        callback_id, _, settings = value.rpartition('=')
+        sample_rate, _, max_body = settings.partition(',')
+        return callback_id, (float(sample_rate), int(max_body) if max_body else None)
@@ -0,0 +1,55 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded callback payloads limited by their total size in bytes.
+
+    `generation` changes on every `clear()`. A payload read before a clear is not stored after it,
+    so a write that races with a read can't leave a stale entry behind.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries: OrderedDict[Hashable, bytes] = OrderedDict()
+
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+
+    def put(self, key: Hashable, value: bytes, generation: int) -> None:
+        if generation != self.generation or len(value) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+        self.generation += 1
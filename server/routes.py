@@ -9,6 +9,7 @@ import server.handlers as handlers
 
 ROUTES = (
     web.RouteDef('GET',  '/',         handler=handlers.index,            kwargs={'name': 'index'}),
+    web.RouteDef('GET',  '/metrics',  handler=handlers.metrics_handler,  kwargs={'name': 'metrics'}),
     web.RouteDef('POST', '/callback', handler=handlers.callback_handler, kwargs={'name': 'callback'})
 )
 
@@ -0,0 +1,154 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+from typing import Any, Callable, Optional
+
+# Takes a decoded JSON value, returns the error message or None if the value is valid
+Validator = Callable[[Any], Optional[str]]
+
+_TYPES = {
+    'object': (dict,),
+    'array': (list,),
+    'string': (str,),
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'null': (type(None),),
+}
+_TYPE_NAMES = {'object': 'an object', 'array': 'an array', 'string': 'a string', 'integer': 'an integer', 'number': 'a number', 'boolean': 'a boolean', 'null': 'null'}
+# Keywords that don't constrain the value
+_ANNOTATIONS = {'$schema', 'title', 'description'}
+_KEYWORDS = _ANNOTATIONS | {'type', 'properties', 'required', 'additionalProperties', 'items', 'minItems', 'maxItems', 'minLength', 'maxLength', 'minimum', 'maximum', 'enum'}
+
+
+class _Compiler:
+    """Writes the source of a validator function, one block of checks per schema in the tree."""
+
+    def __init__(self) -> None:
+        self.lines: list[str] = []
+        self.constants: dict[str, Any] = {}
+        self.variables = 0
+
+
+    def constant(self, value: Any) -> str:
+        name = f'c{len(self.constants)}'
+        self.constants[name] = value
+        return name
+
+
+    def variable(self, prefix: str) -> str:
+        self.variables += 1
+        return f'{prefix}{self.variables}'
+
+
+    def emit(self, indent: int, line: str) -> None:
+        self.lines.append('    ' * indent + line)
+
+
+    def fail(self, indent: int, path: str, message: str) -> None:
+        # `path` is the text of an f-string, so the indexes of array items end up in the message
+        self.emit(indent, f'return f{(path + " " + message.replace("{", "{{").replace("}", "}}"))!r}')
+
+
+    def schema(self, schema: dict, value: str, path: str, indent: int) -> None:
+        unknown = set(schema) - _KEYWORDS
+        if unknown:
+            raise ValueError(f'Unsupported schema keywords at {path}: {", ".join(sorted(unknown))}')
+
+        names = schema.get('type')
+        types: tuple = ()
+        if names is not None:
+            names = [names] if isinstance(names, str) else names
+            types = tuple(t for name in names for t in _TYPES[name])
+            condition = f'not isinstance({value}, {self.constant(types)})'
+            # bool is a subclass of int in Python, but not a number in JSON
+            if 'boolean' not in names and ('integer' in names or 'number' in names):
+                condition += f' or {value}.__class__ is bool'
+            self.emit(indent, f'if {condition}:')
+            self.fail(indent + 1, path, f'must be {" or ".join(_TYPE_NAMES[name] for name in names)}')
+
+        if 'enum' in schema:
+            self.emit(indent, f'if {value} not in {self.constant(schema["enum"])}:')
+            self.fail(indent + 1, path, f'must be one of {", ".join(map(repr, schema["enum"]))}')
+
+        if 'minimum' in schema or 'maximum' in schema:
+            low, high = schema.get('minimum', float('-inf')), schema.get('maximum', float('inf'))
+            self.emit(indent, f'if isinstance({value}, (int, float)) and not {self.constant(low)} <= {value} <= {self.constant(high)}:')
+            self.fail(indent + 1, path, f'must be from {low} to {high}')
+
+        if 'minLength' in schema or 'maxLength' in schema:
+            shortest, longest = schema.get('minLength', 0), schema.get('maxLength', float('inf'))
+            self.emit(indent, f'if isinstance({value}, str) and not {self.constant(shortest)} <= len({value}) <= {self.constant(longest)}:')
+            self.fail(indent + 1, path, f'must be from {shortest} to {longest} characters long')
+
+        if {'required', 'properties', 'additionalProperties'} & set(schema):
+            self.object(schema, value, path, indent, types == (dict,))
+
+        if {'items', 'minItems', 'maxItems'} & set(schema):
+            self.array(schema, value, path, indent, types == (list,))
+
+
+    def object(self, schema: dict, value: str, path: str, indent: int, checked: bool) -> None:
+        if not checked:
+            self.emit(indent, f'if isinstance({value}, dict):')
+            indent += 1
+        self.emit(indent, 'pass')
+
+        for name in schema.get('required', ()):
+            self.emit(indent, f'if {name!r} not in {value}:')
+            self.fail(indent + 1, f'{path}.{_escape(name)}', 'is required')
+
+        for name, subschema in schema.get('properties', {}).items():
+            if not set(subschema) - _ANNOTATIONS:
+                continue
+            item = self.variable('v')
+            self.emit(indent, f'if {name!r} in {value}:')
+            self.emit(indent + 1, f'{item} = {value}[{name!r}]')
+            self.schema(subschema, item, f'{path}.{_escape(name)}', indent + 1)
+
+        if schema.get('additionalProperties') is False:
+            key = self.variable('k')
+            self.emit(indent, f'for {key} in {value}:')
+            self.emit(indent + 1, f'if {key} not in {self.constant(frozenset(schema.get("properties", ())))}:')
+            self.fail(indent + 2, f'{path}.{{{key}}}', 'is not allowed')
+
+
+    def array(self, schema: dict, value: str, path: str, indent: int, checked: bool) -> None:
+        if not checked:
+            self.emit(indent, f'if isinstance({value}, list):')
+            indent += 1
+        self.emit(indent, 'pass')
+
+        if 'minItems' in schema or 'maxItems' in schema:
+            fewest, most = schema.get('minItems', 0), schema.get('maxItems', float('inf'))
+            self.emit(indent, f'if not {self.constant(fewest)} <= len({value}) <= {self.constant(most)}:')
+            self.fail(indent + 1, path, f'must have from {fewest} to {most} items')
+
+        if set(schema.get('items', {})) - _ANNOTATIONS:
+            index, item = self.variable('i'), self.variable('v')
+            self.emit(indent, f'for {index}, {item} in enumerate({value}):')
+            self.schema(schema['items'], item, f'{path}[{{{index}}}]', indent + 1)
+
+
+def _escape(text: str) -> str:
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def compile_schema(schema: dict, path: str = 'payload') -> Validator:
+    """
+    Turns a JSON schema into a function that validates a decoded value against it.
+
+    The schema is read once to write the source of a function with all of its checks inlined, so validating a value
+    doesn't look the keywords up or call a function per nested value. Only the keywords of draft-04 used by the
+    callback schemas are supported, a schema with any other keyword is rejected here rather than partially checked.
+    `path` names the value in the error messages.
+    """
+    compiler = _Compiler()
+    compiler.emit(0, 'def validate(value):')
+    compiler.schema(schema, 'value', _escape(path), 1)
+    compiler.emit(1, 'return None')
+    namespace = dict(compiler.constants)
+    exec('\n'.join(compiler.lines), namespace)
+    return namespace['validate']
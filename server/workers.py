@@ -0,0 +1,91 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+import os
+import signal
+import logging
+import threading
+import multiprocessing
+from time import monotonic, sleep
+from multiprocessing.connection import wait
+from typing import Callable
+
+# A worker that exits sooner than this after it started is restarted with a delay, so a crash loop doesn't spin
+MIN_UPTIME = 5.0
+RESTART_DELAY = 1.0
+# Seconds the workers have to finish their requests on shutdown before they are killed
+SHUTDOWN_TIMEOUT = 30.0
+# Seconds between checks whether the supervisor is still running
+PARENT_CHECK_INTERVAL = 1.0
+
+
+def _exit_with_parent(parent: int) -> None:
+    # A killed supervisor can't stop its workers, they would keep holding the port. Once the parent is gone the worker
+    # is reparented, then it stops as if the supervisor had sent SIGTERM.
+    while os.getppid() == parent:
+        sleep(PARENT_CHECK_INTERVAL)
+    logging.info('Supervisor with pid %d exited, stopping', parent)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _worker(target: Callable[..., None], args: tuple, parent: int) -> None:
+    # In its own process group a worker doesn't get the terminal's Ctrl+C, it's stopped by the supervisor only
+    os.setpgrp()
+    threading.Thread(target=_exit_with_parent, args=(parent,), name='parent-watch', daemon=True).start()
+    target(*args)
+
+
+def supervise(target: Callable[..., None], args: tuple, workers: int) -> None:
+    """
+    Runs `target(*args, index)` in `workers` processes and restarts the ones that exit, until SIGINT or SIGTERM.
+    The workers are then sent SIGTERM, so they stop accepting connections and finish the requests in progress.
+    Workers that are still running after `SHUTDOWN_TIMEOUT` are killed. Workers stop the same way on their own when
+    the supervisor exits without stopping them, such as when it's killed.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes: dict[int, tuple[multiprocessing.Process, float]] = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    def start(index: int):
+        process = context.Process(target=_worker, args=(target, (*args, index), os.getpid()), name=f'worker-{index}')
+        process.start()
+        processes[index] = (process, monotonic())
+        logging.info('Started worker %d with pid %d', index, process.pid)
+
+    for index in range(workers):
+        start(index)
+
+    while not stopping:
+        sentinels = {process.sentinel: index for index, (process, _) in processes.items()}
+        # The timeout only bounds how long a signal may wait to be noticed
+        for sentinel in wait(list(sentinels), timeout=1.0):
+            if stopping:
+                break
+            index = sentinels[sentinel]
+            process, started = processes[index]
+            process.join()
+            logging.info('Worker %d with pid %d exited with code %s, restarting it', index, process.pid, process.exitcode)
+            if monotonic() - started < MIN_UPTIME:
+                sleep(RESTART_DELAY)
+            start(index)
+
+    logging.info('Stopping %d workers...', len(processes))
+    for process, _ in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = monotonic() + SHUTDOWN_TIMEOUT
+    for process, _ in processes.values():
+        process.join(max(0.0, deadline - monotonic()))
+        if process.is_alive():
+            logging.info('Worker with pid %d did not stop in time, killing it', process.pid)
+            process.kill()
+            process.join()
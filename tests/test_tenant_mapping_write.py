@@ -0,0 +1,121 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Checks that the set-based tenant_mapping.write leaves the same mapping behind and fails the same way as the
+# per-item implementation it replaced.
+# Run from the repository root: python -m unittest discover tests
+
+import random
+import sqlite3
+import unittest
+
+from datatypes import OrganizationKind
+from server.callbacks.enablement import write_tenant_mapping
+from benchmarks.tenant_mapping_write import PARTNER_ID, DATACENTER_URL, per_item_write, build_database, random_modified
+
+CUSTOMERS = 20
+SUB_PARTNER_ID = 'sub-partner'
+OTHER_PARTNER_ID = 'other-partner'
+
+
+def setup_database() -> sqlite3.Connection:
+    """Customers c0..c19 of the partner, the even ones mapped to a0, a2..., and a sub-partner and a foreign customer."""
+    db = build_database(CUSTOMERS)
+    db.execute('INSERT INTO organizations VALUES (?,?,?,?)', (SUB_PARTNER_ID, PARTNER_ID, SUB_PARTNER_ID, OrganizationKind.PARTNER))
+    db.execute('INSERT INTO organizations VALUES (?,?,?,?)', (OTHER_PARTNER_ID, None, OTHER_PARTNER_ID, OrganizationKind.PARTNER))
+    db.execute('INSERT INTO organizations VALUES (?,?,?,?)', ('foreign', OTHER_PARTNER_ID, 'foreign', OrganizationKind.CUSTOMER))
+    db.commit()
+    return db
+
+
+def apply(write, modified: list[dict], organization_id: str = PARTNER_ID) -> tuple[object, list[tuple]]:
+    """Runs `write` in a transaction as the callback does, returns its outcome and the mapping left behind."""
+    db = setup_database()
+    try:
+        with db:
+            outcome = write(db, organization_id, DATACENTER_URL, modified)
+    except sqlite3.Error as e:
+        outcome = type(e)
+    return outcome, [tuple(row) for row in db.execute('SELECT * FROM organizations_mapping ORDER BY organization_id')]
+
+
+class TenantMappingWriteTest(unittest.TestCase):
+
+    def assert_equivalent(self, modified: list[dict], organization_id: str = PARTNER_ID) -> tuple[object, list[tuple]]:
+        expected = apply(per_item_write, modified, organization_id)
+        self.assertEqual(apply(write_tenant_mapping, modified, organization_id), expected)
+        return expected
+
+
+    def test_maps_and_takes_over_tenants(self):
+        outcome, rows = self.assert_equivalent([
+            {'vendor_tenant_id': 'c1', 'acronis_tenant_id': 'new1'},
+            {'vendor_tenant_id': 'c3', 'acronis_tenant_id': 'a0'},
+        ])
+        self.assertIsNone(outcome)
+        self.assertIn(('c1', 'new1', DATACENTER_URL), rows)
+        self.assertIn(('c3', 'a0', DATACENTER_URL), rows)
+        self.assertNotIn('c0', [row[0] for row in rows])
+
+
+    def test_duplicate_tenants_last_wins(self):
+        outcome, rows = self.assert_equivalent([
+            {'vendor_tenant_id': 'c1', 'acronis_tenant_id': 'dup'},
+            {'vendor_tenant_id': 'c3', 'acronis_tenant_id': 'dup'},
+            {'vendor_tenant_id': 'c5', 'acronis_tenant_id': 'dup'},
+        ])
+        self.assertIsNone(outcome)
+        self.assertEqual([row for row in rows if row[1] == 'dup'], [('c5', 'dup', DATACENTER_URL)])
+
+
+    def test_unmaps_with_null_empty_or_missing_tenant(self):
+        outcome, rows = self.assert_equivalent([
+            {'vendor_tenant_id': 'c0', 'acronis_tenant_id': None},
+            {'vendor_tenant_id': 'c2', 'acronis_tenant_id': ''},
+            {'vendor_tenant_id': 'c4'},
+            {'vendor_tenant_id': 'c1', 'acronis_tenant_id': None},
+        ])
+        self.assertIsNone(outcome)
+        self.assertFalse({'c0', 'c2', 'c4'} & {row[0] for row in rows})
+
+
+    def test_rejects_unowned_organizations_and_rolls_back(self):
+        unchanged = apply(lambda *args: None, [])[1]
+        for vendor in ('foreign', 'missing', SUB_PARTNER_ID, PARTNER_ID):
+            with self.subTest(vendor=vendor):
+                # The valid item before the rejected one is not written either
+                outcome, rows = self.assert_equivalent([
+                    {'vendor_tenant_id': 'c0', 'acronis_tenant_id': None},
+                    {'vendor_tenant_id': vendor, 'acronis_tenant_id': 'new'},
+                ])
+                self.assertEqual(outcome, 'Failed to write the mapping.')
+                self.assertEqual(rows, unchanged)
+
+
+    def test_nothing_to_map_without_customers(self):
+        outcome, _ = self.assert_equivalent([{'vendor_tenant_id': 'c1', 'acronis_tenant_id': 'new'}], organization_id='c0')
+        self.assertEqual(outcome, 'Nothing to map')
+
+
+    def test_remapping_a_mapped_customer_fails_and_rolls_back(self):
+        unchanged = apply(lambda *args: None, [])[1]
+        outcome, rows = self.assert_equivalent([
+            {'vendor_tenant_id': 'c1', 'acronis_tenant_id': 'new1'},
+            {'vendor_tenant_id': 'c0', 'acronis_tenant_id': 'new0'},
+        ])
+        self.assertIs(outcome, sqlite3.IntegrityError)
+        self.assertEqual(rows, unchanged)
+
+
+    def test_random_bulk_write(self):
+        rng = random.Random(0)
+        for _ in range(20):
+            with self.subTest(seed=rng.random()):
+                outcome, _ = self.assert_equivalent(random_modified(CUSTOMERS, 10, rng))
+                self.assertIsNone(outcome)
+
+
+if __name__ == '__main__':
+    unittest.main()
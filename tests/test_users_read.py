@@ -0,0 +1,107 @@
+# ************************************************************
+# Copyright © 2003-2024 Acronis International GmbH.
+# This source code is distributed under MIT software license.
+# ************************************************************
+
+# Checks the users_read pages and cursors.
+# Run from the repository root: python -m unittest discover tests
+
+import sqlite3
+import unittest
+from base64 import urlsafe_b64encode
+from unittest import mock
+
+from create_db import create_tables
+from migrations import migrate
+from server.callbacks import user_management
+from server.callbacks.user_management import USERS_OF_ORGANIZATION, _users_of_organizations, _read_users_page, _encode_cursor, _decode_cursor
+
+ORGANIZATION_IDS = ['o0', 'o1', 'o2', 'o3']
+# Users by organization, o2 has none
+USERS = {'o0': 7, 'o1': 1, 'o2': 0, 'o3': 12}
+
+
+def setup_database() -> sqlite3.Connection:
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    create_tables(db)
+    with mock.patch('migrations.logging'):
+        migrate(db)
+    db.executemany('INSERT INTO organizations VALUES (?,?,?,?)', ((id, None, id, 0) for id in ORGANIZATION_IDS))
+    db.executemany('INSERT INTO users VALUES (?,?,?,?,?,?)', (
+        (f'{organization_id}-u{i:02}', f'{organization_id}-{i}', f'User {i}', f'{i}@example.com', None, organization_id)
+        for organization_id, count in USERS.items() for i in range(count)
+    ))
+    db.commit()
+    return db
+
+
+def encode(value) -> str:
+    return urlsafe_b64encode(user_management.codec.dumps(value)).decode()
+
+
+class UsersPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = setup_database()
+        self.users = [tuple(row) for row in self.db.execute('SELECT id, name, email, organization_id FROM users ORDER BY organization_id, id')]
+
+
+    def tearDown(self):
+        self.db.close()
+
+
+    def test_seeks_to_the_cursor_in_its_organization(self):
+        plan = [row[3] for row in self.db.execute(f'EXPLAIN QUERY PLAN {USERS_OF_ORGANIZATION}', ('o0', 'u03', 10))]
+        self.assertEqual(len(plan), 1)
+        self.assertIn('COVERING INDEX', plan[0])
+        self.assertIn('id>?', plan[0])
+
+
+    def test_reads_following_organizations_in_order_from_the_index(self):
+        plan = [row[3] for row in self.db.execute(f'EXPLAIN QUERY PLAN {_users_of_organizations(3)}', ('o1', 'o2', 'o3', 10))]
+        self.assertEqual(len(plan), 1)
+        self.assertIn('COVERING INDEX', plan[0])
+
+
+    def test_pages_return_every_user_once_in_order(self):
+        for page_size in (1, 2, 3, 7, 8, 100):
+            with self.subTest(page_size=page_size), mock.patch.object(user_management, 'USERS_PAGE_SIZE', page_size), \
+                    mock.patch.object(user_management, 'USERS_PAGE_ORGANIZATIONS', 2):
+                read, after, more = [], ('', ''), True
+                while more:
+                    rows, more = _read_users_page(self.db, ORGANIZATION_IDS, after, None)
+                    read += [tuple(row) for row in rows]
+                    after = (rows[-1]['organization_id'], rows[-1]['id'])
+                self.assertEqual(read, self.users)
+
+
+    def test_limit_and_cursors_of_unlisted_organizations(self):
+        rows, more = _read_users_page(self.db, ORGANIZATION_IDS, ('o0', 'o0-u05'), 3)
+        self.assertEqual([tuple(row) for row in rows], self.users[6:9])
+        self.assertTrue(more)
+        # An organization that is no longer listed continues with the next one
+        rows, _ = _read_users_page(self.db, ORGANIZATION_IDS, ('o0~', ''), 2)
+        self.assertEqual([tuple(row) for row in rows], self.users[7:9])
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(_decode_cursor(_encode_cursor({'organization_id': 'o1', 'id': 'u01'})), ('o1', 'u01'))
+
+
+    def test_rejects_values_other_than_two_strings(self):
+        for value in ({'a': 1, 'b': 2}, 'ab', ['o1'], ['o1', 'u1', 'x'], ['o1', 2], [None, 'u1'], 12):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                _decode_cursor(encode(value))
+
+
+    def test_rejects_garbage(self):
+        for cursor in ('not base64!', encode('x')[:-2] + '@@', urlsafe_b64encode(b'{').decode()):
+            with self.subTest(cursor=cursor), self.assertRaises(ValueError):
+                _decode_cursor(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,11 +17,121 @@ def verify(hash: str, password: str) -> bool:
     return h.verify(hash, password)
 
 
-def sqlite_connect(filename: str) -> sqlite3.Connection:
-    db = sqlite3.connect(filename)
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def sqlite_connect(filename: str, **kwargs) -> sqlite3.Connection:
+    db = sqlite3.connect(filename, **kwargs)
     db.row_factory = sqlite3.Row
     db.execute('PRAGMA foreign_keys=ON')
     db.execute('PRAGMA journal_mode=WAL')
     db.execute('PRAGMA synchronous=normal')
     db.execute('PRAGMA journal_size_limit=67110000')
     return db
+
+
+def create_organizations_closure(db: sqlite3.Connection) -> None:
+    """
+    Creates the `organizations_closure` table that holds a row for every (ancestor, descendant) pair of organizations,
+    including each organization paired with itself at depth 0. Triggers keep it up to date on insert and move,
+    deleted organizations are removed by the foreign keys.
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS organizations_closure (
+        ancestor_id VARCHAR(36) NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        descendant_id VARCHAR(36) NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    ) WITHOUT ROWID''')
+    db.execute('CREATE INDEX IF NOT EXISTS organizations_closure_descendant_idx ON organizations_closure(descendant_id, depth)')
+
+    db.execute('''CREATE TRIGGER IF NOT EXISTS organizations_closure_insert AFTER INSERT ON organizations
+    BEGIN
+        INSERT INTO organizations_closure (ancestor_id, descendant_id, depth)
+        SELECT NEW.id, NEW.id, 0
+        UNION ALL
+        SELECT ancestor_id, NEW.id, depth + 1 FROM organizations_closure WHERE descendant_id = NEW.parent_id;
+    END''')
+    db.execute('''CREATE TRIGGER IF NOT EXISTS organizations_closure_move AFTER UPDATE OF parent_id ON organizations
+    WHEN OLD.parent_id IS NOT NEW.parent_id
+    BEGIN
+        DELETE FROM organizations_closure
+        WHERE descendant_id IN (SELECT descendant_id FROM organizations_closure WHERE ancestor_id = NEW.id)
+        AND ancestor_id IN (SELECT ancestor_id FROM organizations_closure WHERE descendant_id = NEW.id AND depth > 0);
+
+        INSERT INTO organizations_closure (ancestor_id, descendant_id, depth)
+        SELECT up.ancestor_id, down.descendant_id, up.depth + down.depth + 1
+        FROM organizations_closure AS up, organizations_closure AS down
+        WHERE up.descendant_id = NEW.parent_id AND down.ancestor_id = NEW.id;
+    END''')
+
+
+# Tables whose changes are recorded in `change_log`, with the column that identifies a row
+CHANGE_LOG_TABLES = {'organizations': 'id', 'organizations_mapping': 'organization_id', 'users': 'id'}
+# Seconds changes are kept in the change log, consumers that haven't saved their position for this long are not waited for
+CHANGE_LOG_RETENTION = 24 * 60 * 60
+
+
+def create_change_log(db: sqlite3.Connection) -> None:
+    """
+    Creates the `change_log` table where triggers record the key of every inserted, updated or deleted row of
+    `CHANGE_LOG_TABLES`, and `change_log_consumers` with the id of the last change each consumer has processed.
+    Ids only grow, so a consumer reads its new changes by the primary key.
+    """
+    db.execute('''CREATE TABLE IF NOT EXISTS change_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name VARCHAR(32) NOT NULL,
+        row_id VARCHAR(36) NOT NULL,
+        operation CHAR(1) NOT NULL,
+        changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )''')
+    db.execute('''CREATE TABLE IF NOT EXISTS change_log_consumers (
+        name VARCHAR(64) NOT NULL PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+
+    for table, key in CHANGE_LOG_TABLES.items():
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_change_log_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO change_log (table_name, row_id, operation) VALUES ('{table}', NEW.{key}, 'I');
+        END''')
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_change_log_update AFTER UPDATE ON {table}
+        BEGIN
+            INSERT INTO change_log (table_name, row_id, operation) SELECT '{table}', OLD.{key}, 'D' WHERE OLD.{key} IS NOT NEW.{key};
+            INSERT INTO change_log (table_name, row_id, operation) VALUES ('{table}', NEW.{key}, 'U');
+        END''')
+        db.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_change_log_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO change_log (table_name, row_id, operation) VALUES ('{table}', OLD.{key}, 'D');
+        END''')
+
+
+def prune_change_log(db: sqlite3.Connection, now: int, retention: int = CHANGE_LOG_RETENTION) -> None:
+    """
+    Deletes the changes that every active consumer has processed and all changes older than `retention` seconds.
+    A consumer is active if it has saved its position within `retention` seconds.
+    """
+    cutoff = now - retention
+    db.execute('DELETE FROM change_log WHERE id <= (SELECT MIN(last_id) FROM change_log_consumers WHERE updated_at >= ?)', (cutoff,))
+    # Changes are added in time order, so the old ones are found by reading from the first change up to the first recent one
+    db.execute('''DELETE FROM change_log WHERE id < COALESCE(
+        (SELECT id FROM change_log WHERE changed_at >= ? ORDER BY id LIMIT 1),
+        (SELECT MAX(id) + 1 FROM change_log)
+    )''', (cutoff,))
+
+
+def backfill_organizations_closure(db: sqlite3.Connection) -> None:
+    db.execute('DELETE FROM organizations_closure')
+    db.execute('''INSERT INTO organizations_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM organizations
+
+            UNION ALL
+
+            SELECT tree.ancestor_id, orgs.id, tree.depth + 1
+            FROM tree JOIN organizations AS orgs ON orgs.parent_id = tree.descendant_id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM tree''')